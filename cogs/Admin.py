@@ -8,17 +8,27 @@ import io
 from contextlib import redirect_stdout, suppress
 import textwrap
 import traceback
+import tracemalloc
+import gc
+import os
+from collections import Counter
 
 from utils import StripCodeblocks
 
 
 SUPPORT_SERVER_ID = 798329404325101600
+MAX_EMOJI_SIZE = 256 * 1024  # discord's limit
+MAX_WORD_LIST_SIZE = 1024 * 1024
+TRACKED_TYPES = ("Player", "Track", "SnakeMenu", "TicTacToe")
 
 
 class Admin(commands.Cog):
     """
     Commands that only my owner can use.
     """
+    def __init__(self):
+        self.memory_snapshot = None
+
     async def cog_check(self, ctx):
         if not await ctx.bot.is_owner(ctx.author):
             raise commands.NotOwner
@@ -143,23 +153,24 @@ class Admin(commands.Cog):
         `emoji` - The emoji to snipe (can NOT be unicode).
         """
         if emoji:
-            emoji = await emoji.url.read()
+            source = emoji.url
         else:
             if not ctx.message.attachments:
                 return await ctx.send("No emoji provided.")
-            emoji = await ctx.message.attachments[0].read()
+            source = ctx.message.attachments[0]
+        emoji = await ctx.bot.utils.fetch_attachment(ctx.bot.session, source, max_size=MAX_EMOJI_SIZE, kind="image")
         await ctx.bot.get_guild(SUPPORT_SERVER_ID).create_custom_emoji(name=name, image=emoji)
         await ctx.send("👌")
 
     @admin.group(invoke_without_command=True)
     async def error(self, ctx):
         """
-        View the errors in the database.
+        View the errors in the database, most frequent first.
         """
-        errors = await ctx.bot.pool.fetch("SELECT * FROM errors")
-        if not errors:
+        await ctx.bot.cache.flush_errors()
+        if not await ctx.bot.pool.fetchval("SELECT EXISTS (SELECT 1 FROM errors)"):
             return await ctx.send("No errors in the database! 🥳")
-        await menus.MenuPages(ctx.bot.utils.ErrorSource(errors, per_page=1), delete_message_after=True).start(ctx)
+        await menus.MenuPages(ctx.bot.utils.LazyErrorSource(ctx.bot.pool), delete_message_after=True).start(ctx)
 
     @error.command()
     async def view(self, ctx, err_num: int):
@@ -182,9 +193,8 @@ class Admin(commands.Cog):
         """
         if re.match(r"\d+-\d+", error):  # x-x
             rnge = error.split("-")
-            for i in range(int(rnge[0]), int(rnge[1]) + 1):
-                await ctx.bot.pool.execute("DELETE FROM errors WHERE err_num = $1", i)
-            await ctx.send(f"Successfully removed errors `{rnge[0]}` to `{rnge[1]}`.")
+            status = await ctx.bot.pool.execute("DELETE FROM errors WHERE err_num BETWEEN $1 AND $2", int(rnge[0]), int(rnge[1]))
+            await ctx.send(f"Successfully removed `{status.split()[-1]}` errors from `{rnge[0]}` to `{rnge[1]}`.")
         elif error.lower() == "all":
             await ctx.bot.pool.execute("DELETE FROM errors")
             await ctx.send("Thanks for fixing all my errors!")
@@ -194,6 +204,210 @@ class Admin(commands.Cog):
         else:
             await ctx.send("Invalid option.")
 
+    @staticmethod
+    async def send_table(ctx, rows, *, per_page=15):
+        lines = [f"{str(k).ljust(25)} {v}" for k, v in rows]
+        pages = ["\n".join(lines[i:i + per_page]) for i in range(0, len(lines), per_page)]
+        await menus.MenuPages(ctx.bot.utils.PaginatorSource(pages, per_page=1), delete_message_after=True).start(ctx)
+
+    @admin.group(invoke_without_command=True)
+    async def history(self, ctx, days: int = 7):
+        """
+        View the most used commands over the last `days` days.
+
+        `days` - The amount of days to look back. Defaults to 7.
+        """
+        rows = await ctx.bot.pool.fetch("""SELECT command, SUM(uses) FROM daily_command_stats
+        WHERE date >= CURRENT_DATE - $1::int GROUP BY command ORDER BY 2 DESC""", days)
+        if not rows:
+            return await ctx.send(f"No command stats for the last `{days}` days.")
+        await self.send_table(ctx, rows)
+
+    @history.command(name="users")
+    async def history_users(self, ctx, days: int = 7, limit: int = 100):
+        """
+        View the users who used the most commands over the last `days` days.
+
+        `days` - The amount of days to look back. Defaults to 7.
+        `limit` - The amount of users to show. Defaults to 100.
+        """
+        rows = await ctx.bot.pool.fetch("""SELECT user_id, SUM(uses) FROM daily_user_stats
+        WHERE date >= CURRENT_DATE - $1::int GROUP BY user_id ORDER BY 2 DESC LIMIT $2""", days, limit)
+        if not rows:
+            return await ctx.send(f"No user stats for the last `{days}` days.")
+        await self.send_table(ctx, rows)
+
+    @history.command()
+    async def trend(self, ctx, command: str, days: int = 30):
+        """
+        View the daily uses of a command over the last `days` days.
+
+        `command` - The qualified name of the command.
+        `days` - The amount of days to look back. Defaults to 30.
+        """
+        rows = await ctx.bot.pool.fetch("""SELECT date, uses FROM daily_command_stats
+        WHERE command = $1 AND date >= CURRENT_DATE - $2::int ORDER BY date""", command, days)
+        if not rows:
+            return await ctx.send(f"No stats for `{command}` in the last `{days}` days.")
+        await self.send_table(ctx, rows)
+
+    @admin.command()
+    async def latency(self, ctx, *, command: str = None):
+        """
+        View the latency of every command since the last restart.
+
+        `command` - Only show the latency of this command (Optional).
+        """
+        latencies = ctx.bot.cache.command_latencies
+        if command is not None:
+            latencies = {k: v for k, v in latencies.items() if k == command}
+        if not latencies:
+            return await ctx.send("No latency has been recorded yet.")
+        lines = ctx.bot.utils.latency_table(latencies)
+        pages = ["\n".join([lines[0]] + lines[i:i + 15]) for i in range(1, len(lines), 15)]
+        await menus.MenuPages(ctx.bot.utils.PaginatorSource(pages, per_page=1), delete_message_after=True).start(ctx)
+
+    @admin.group(invoke_without_command=True)
+    async def stalls(self, ctx):
+        """
+        View the stacks that blocked the event loop, most frequent first.
+        """
+        detector = ctx.bot.stall_detector
+        stacks = detector.most_common()
+        if not stacks:
+            return await ctx.send(f"The event loop hasn't been blocked for more than `{detector.threshold}s` yet. "
+                                  f"Current lag: `{detector.lag * 1000:.2f}ms`")
+        pages = [f"Seen {count} time{'' if count == 1 else 's'} (max lag {detector.max_lag:.3f}s)\n\n{stack[-1800:]}"
+                 for stack, count in stacks]
+        await menus.MenuPages(ctx.bot.utils.PaginatorSource(pages, per_page=1), delete_message_after=True).start(ctx)
+
+    @stalls.command(name="clear")
+    async def stalls_clear(self, ctx):
+        """
+        Clears the recorded stacks.
+        """
+        ctx.bot.stall_detector.clear()
+        await ctx.send("👌")
+
+    @commands.max_concurrency(1)
+    @admin.command()
+    async def profile(self, ctx, seconds: float = 10):
+        """
+        Profiles every thread (including the event loop) for a while and uploads the result as collapsed stacks for flamegraph tools.
+
+        `seconds` - How long to profile for, up to 60 seconds. Defaults to 10.
+        """
+        if not 0 < seconds <= 60:
+            return await ctx.send("Profiling can take up to `60` seconds.")
+        profiler = ctx.bot.utils.SamplingProfiler()
+        async with ctx.typing():
+            await profiler.run(seconds)
+            url = await ctx.bot.mystbin(profiler.collapsed())
+        await ctx.send(f"Collected `{profiler.sample_count}` samples over `{seconds}` seconds: {url}")
+
+    @admin.group(invoke_without_command=True)
+    async def memory(self, ctx):
+        """
+        Memory commands.
+        """
+        rss = ctx.bot.process.memory_info().rss / 1024 ** 2
+        if not tracemalloc.is_tracing():
+            return await ctx.send(f"RSS: `{rss:.2f} MiB`. Tracing is off, start it with `{ctx.prefix}admin memory snapshot`.")
+        current, peak = tracemalloc.get_traced_memory()
+        await ctx.send(f"RSS: `{rss:.2f} MiB`\nTraced: `{current / 1024 ** 2:.2f} MiB` (peak `{peak / 1024 ** 2:.2f} MiB`)")
+
+    @staticmethod
+    async def take_snapshot(ctx):
+        snapshot = await ctx.bot.loop.run_in_executor(None, tracemalloc.take_snapshot)
+        return snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+
+    @memory.command()
+    async def snapshot(self, ctx):
+        """
+        Takes a snapshot to diff against, starting tracing if it isn't running yet.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            await ctx.send("Started tracing. Only allocations made from now on are traced.")
+        self.memory_snapshot = await self.take_snapshot(ctx)
+        current, _ = tracemalloc.get_traced_memory()
+        await ctx.send(f"Took a snapshot of `{current / 1024 ** 2:.2f} MiB` traced memory.")
+
+    @memory.command()
+    async def diff(self, ctx, limit: int = 100):
+        """
+        View the top allocation growth by file and line since the last snapshot.
+
+        `limit` - The amount of lines to show. Defaults to 100.
+        """
+        if self.memory_snapshot is None or not tracemalloc.is_tracing():
+            return await ctx.send(f"Take a snapshot first with `{ctx.prefix}admin memory snapshot`.")
+        snapshot = await self.take_snapshot(ctx)
+        stats = [stat for stat in snapshot.compare_to(self.memory_snapshot, "lineno") if stat.size_diff > 0][:limit]
+        if not stats:
+            return await ctx.send("Nothing has grown since the last snapshot.")
+        lines = []
+        for stat in stats:
+            frame = stat.traceback[0]
+            location = f"{os.sep.join(frame.filename.split(os.sep)[-2:])}:{frame.lineno}"
+            lines.append(f"{location}\n    +{stat.size_diff / 1024:.1f} KiB ({stat.count_diff:+} blocks), "
+                         f"{stat.size / 1024:.1f} KiB total")
+        total = sum(stat.size_diff for stat in stats) / 1024
+        pages = [f"Top growth: +{total:.1f} KiB\n\n" + "\n".join(lines[i:i + 10]) for i in range(0, len(lines), 10)]
+        await menus.MenuPages(ctx.bot.utils.PaginatorSource(pages, per_page=1), delete_message_after=True).start(ctx)
+
+    @memory.command()
+    async def objects(self, ctx):
+        """
+        View how many of our own objects and cache entries are alive.
+        """
+        counts = Counter({name: 0 for name in TRACKED_TYPES})
+        counts.update(type(obj).__name__ for obj in gc.get_objects() if type(obj).__name__ in counts)
+        cache = ctx.bot.cache
+        rows = [*counts.items(),
+                ("guild_cache", len(cache.guild_cache)),
+                ("prefix_matchers", len(cache.prefix_matchers)),
+                ("todos", len(cache.todos)),
+                ("unflushed_todos", len(cache.unflushed_todos)),
+                ("top_commands_overall", len(cache.command_stats["top_commands_overall"])),
+                ("top_users_overall", len(cache.command_stats["top_users_overall"])),
+                ("stats_deltas", sum(map(len, cache.stats_deltas.values()))),
+                ("command_latencies", len(cache.command_latencies))]
+        await self.send_table(ctx, rows)
+
+    @memory.command()
+    async def stop(self, ctx):
+        """
+        Stops tracing and drops the snapshot.
+        """
+        tracemalloc.stop()
+        self.memory_snapshot = None
+        await ctx.send("👌")
+
+    @commands.max_concurrency(1)
+    @admin.command()
+    async def warmdefine(self, ctx, *words):
+        """
+        Stores the definitions of a list of words ahead of time.
+
+        `words` - The words, or a text file with one word per line.
+        """
+        if ctx.message.attachments:
+            data = await ctx.bot.utils.fetch_attachment(ctx.bot.session, ctx.message.attachments[0],
+                                                        max_size=MAX_WORD_LIST_SIZE, kind="text")
+            words = data.decode(encoding="utf-8", errors="replace").splitlines()
+        if not words:
+            return await ctx.send("No words or word list provided.")
+        async with ctx.typing():
+            with ctx.bot.utils.StopWatch() as sw:
+                fetched, stored, unknown = await ctx.bot.definitions.warm(words)
+        await ctx.send(f"Fetched `{fetched}` definitions in `{sw.elapsed:.2f}` seconds. "
+                       f"`{stored}` were already stored and `{unknown}` words are unknown.")
+
     @admin.command()
     async def sync(self, ctx):
         """
@@ -7,6 +7,8 @@ import sys
 import inspect
 from jishaku import Jishaku
 
+from dependencies import STATS_WINDOWS
+
 
 class BotInfo(commands.Cog, name="Bot Info"):
     """
@@ -44,6 +46,9 @@ class BotInfo(commands.Cog, name="Bot Info"):
                         value=f"```py\n{await ctx.bot.postgresql_ping() * 1000:.{decimal_places}f}ms```")
         embed.add_field(name="Database Ping (redis)",
                         value=f"```py\n{await ctx.bot.redis_ping() * 1000:.{decimal_places}f}ms```")
+        p50, p95, p99, _ = ctx.bot.cache.overall_latency.summary()
+        embed.add_field(name="Command Latency (p50/p95/p99)",
+                        value=f"```py\n{p50 * 1000:.1f}/{p95 * 1000:.1f}/{p99 * 1000:.1f}ms```")
 
         if "-rtt" in flags or "--round-trip-time" in flags:
             # cooldown check
@@ -203,23 +208,43 @@ class BotInfo(commands.Cog, name="Bot Info"):
             colour=ctx.bot.embed_colour)
         await ctx.send(embed=embed)
 
-    @commands.command()
-    async def stats(self, ctx):
+    @commands.command(usage="[--window 1h|24h|7d] [--latency]")
+    async def stats(self, ctx, *flags):
         """
         Displays the command usage stats.
+
+        **Flags:**
+        `--window 1h|24h|7d` - The time window for the recent stats. Defaults to `24h`.
+        `--latency` - If this flag is provided, the latency of the 10 most used commands since the last restart will be shown instead.
         """
-        top5commands_today = ctx.bot.cache.command_stats["top_commands_today"].most_common(5)
+        if "--latency" in flags:
+            latencies = dict(sorted(ctx.bot.cache.command_latencies.items(), key=lambda item: item[1].count, reverse=True)[:10])
+            if not latencies:
+                return await ctx.send("No commands have been used since the last restart.")
+            table = "\n".join(ctx.bot.utils.latency_table(latencies))
+            embed = discord.Embed(title="Command Latency (ms)", description=f"```\n{table}```", colour=ctx.bot.embed_colour)
+            return await ctx.send(embed=embed)
+
+        window = "24h"
+        if "--window" in flags:
+            try:
+                window = flags[flags.index("--window") + 1].lower()
+            except IndexError:
+                window = None
+            if window not in STATS_WINDOWS:
+                return await ctx.send(f"Invalid window provided. Available windows: `{ctx.bot.utils.humanize_list(list(STATS_WINDOWS))}`")
+
+        top5commands_recent, top5users_recent = await ctx.bot.cache.get_window_stats(window)
+        top5users_recent = [(f"<@!{user_id}>", counter) for user_id, counter in top5users_recent]
         top5commands_overall = ctx.bot.cache.command_stats["top_commands_overall"].most_common(5)
-        top5users_today = [(f"<@!{user_id}>", counter)
-                           for user_id, counter in ctx.bot.cache.command_stats["top_users_today"].most_common(5)]
         top5users_overall = [(f"<@!{user_id}>", counter)
                              for user_id, counter in ctx.bot.cache.command_stats["top_users_overall"].most_common(5)]
 
         embed = discord.Embed(title="Command Stats", colour=ctx.bot.embed_colour)
-        embed.add_field(name="Top 5 Commands Today",
-                        value=ctx.bot.utils.top5(top5commands_today) or "No commands have been used today.")
-        embed.add_field(name="Top 5 Users Today",
-                        value=ctx.bot.utils.top5(top5users_today) or "No one has used any commands today.")
+        embed.add_field(name=f"Top 5 Commands (last {window})",
+                        value=ctx.bot.utils.top5(top5commands_recent) or f"No commands have been used in the last {window}.")
+        embed.add_field(name=f"Top 5 Users (last {window})",
+                        value=ctx.bot.utils.top5(top5users_recent) or f"No one has used any commands in the last {window}.")
         embed.add_field(name="\u200b", value="\u200b")
         embed.add_field(name="Top 5 Commands Overall",
                         value=ctx.bot.utils.top5(top5commands_overall) or "No commands have been used.")
@@ -1,11 +1,11 @@
 import discord
 from discord.ext import commands
-import traceback
 import difflib
 import re
 from contextlib import suppress
 
 from dependencies import StopSpammingMe
+from utils import AttachmentError
 
 
 class ErrorHandling(commands.Cog):
@@ -83,6 +83,9 @@ class ErrorHandling(commands.Cog):
                 colour=ctx.bot.embed_colour)
             await ctx.send(embed=embed)
 
+        elif isinstance(error, AttachmentError):
+            await ctx.send(error)
+
         elif isinstance(error, commands.TooManyArguments):
             await ctx.send(error)
 
@@ -93,12 +96,8 @@ class ErrorHandling(commands.Cog):
             pass
 
         else:
-            # unexpected errors get handled here.
-            tb_lines = traceback.format_exception(type(error), error, error.__traceback__)
-            tb = "".join(tb_lines)
-
-            await ctx.bot.pool.execute("""INSERT INTO errors (traceback, message, command)
-            VALUES ($1, $2, $3)""", tb, ctx.message.content, ctx.command.qualified_name)
+            # unexpected errors get handled here, they are written to the database in the background.
+            ctx.bot.cache.record_error(error, ctx.message.content, ctx.command.qualified_name)
 
             embed = discord.Embed(
                 title=f"An unexpected error occurred in command `{ctx.command}`",
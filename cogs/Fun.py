@@ -28,15 +28,12 @@ class Fun(commands.Cog):
 
         `subreddit` - The subreddit.
         """
-        async with ctx.bot.session.get(f"https://www.reddit.com/r/{subreddit}/new.json") as resp:
-            r = await resp.json()
-        if r.get("error", None) is not None:
+        try:
+            random_post = await ctx.bot.reddit.draw(subreddit)
+        except ctx.bot.utils.SubredditNotFound:
             return await ctx.send("Couldn't find a subreddit with that name.")
-
-        posts = r["data"]["children"]
-        if not posts:
+        if random_post is None:
             return await ctx.send("Apparently there are no posts in this subreddit...")
-        random_post = random.choice(posts)["data"]
         posted_when = datetime.datetime.now() - datetime.datetime.fromtimestamp(random_post["created"])
 
         embed = discord.Embed(
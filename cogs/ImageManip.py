@@ -4,6 +4,8 @@ import polaroid
 from io import BytesIO
 import typing
 
+MAX_IMAGE_SIZE = 8 * 1024 * 1024
+
 
 class ImageManip(commands.Cog):
     """
@@ -12,22 +14,25 @@ class ImageManip(commands.Cog):
     @staticmethod
     async def get_image(ctx, image):
         if ctx.message.attachments:
-            return polaroid.Image(await ctx.message.attachments[0].read())
+            source = ctx.message.attachments[0]
         elif isinstance(image, discord.PartialEmoji):
-            return polaroid.Image(await image.url.read())
+            source = image.url
         else:
             image = image or ctx.author
-            return polaroid.Image(await image.avatar_url_as(format="png").read())
+            source = image.avatar_url_as(format="png")
+        return await ctx.bot.utils.fetch_attachment(ctx.bot.session, source, max_size=MAX_IMAGE_SIZE, kind="image")
 
     @staticmethod
     def _do_image_manip(image, method, *args, **kwargs):
+        # decoding and encoding are as slow as the manipulation itself, so they happen off the event loop too
+        image = polaroid.Image(image)
         method = getattr(image, method)
         method(*args, **kwargs)
-        return image
+        return image.save_bytes()
 
     @staticmethod
-    def build_embed(ctx, image, *, filename: str, elapsed: int):
-        file = discord.File(BytesIO(image.save_bytes()), filename=f"{filename}.png")
+    def build_embed(ctx, image: bytes, *, filename: str, elapsed: int):
+        file = discord.File(BytesIO(image), filename=f"{filename}.png")
         embed = discord.Embed(colour=ctx.bot.embed_colour)
         embed.set_author(name=ctx.author, icon_url=ctx.author.avatar_url)
         embed.set_image(url=f"attachment://{filename}.png")
@@ -88,45 +88,12 @@ class Info(commands.Cog):
         **Flags:**
         `-h|--history` - If this flag is provided, historical data will be shown instead.
         """
-        async with ctx.typing():
-            if "-h" in flags or "--history" in flags:
-                async with ctx.bot.session.get("https://srhpyqt94yxb.statuspage.io/api/v2/incidents.json") as r:
-                    incidents = (await r.json())["incidents"]
-                return await menus.MenuPages(ctx.bot.utils.HistorySource(incidents, per_page=1), clear_reactions_after=True).start(ctx)
-
-            async with ctx.bot.session.get("https://srhpyqt94yxb.statuspage.io/api/v2/summary.json") as r:
-                summary = await r.json()
-
-            # embed 1
-            embed1 = discord.Embed(
-                title="Discord Status\nCurrent Status for Discord",
-                description="```yaml\n"
-                            f"Message: {summary['status']['description']}\n"
-                            f"Impact: {summary['status']['indicator'].title()}\n"
-                            "```",
-                colour=ctx.bot.embed_colour
-            )
-
-            # embed 2
-            embed2 = discord.Embed(title="Discord Status\nCurrent Incidents", colour=ctx.bot.embed_colour)
-            if not summary["incidents"]:
-                embed2.description = "```yaml\nThere are no issues with discord as of yet.```"
-            else:
-                embed2.description = "```yaml\n" + "\n\n".join(
-                    f"Name: {incident.get('name', None)}\n"
-                    f"Message: {incident.get('message', None)}\n"
-                    f"Status: {incident.get('status', None).title()}\n"
-                    f"Impact: {incident.get('impact', None).title()}" for incident in summary["incidents"]
-                ) + "```"
-
-            # embed 3
-            components = {c["name"]: c["status"].title().replace("_", " ") for c in summary["components"]}
-            embed3 = discord.Embed(
-                title="Discord Status\nComponents",
-                description="```yaml\n" + "\n".join(f"{k.rjust(len(max(components.keys(), key=len)))}: {v}" for k, v in components.items()) + "```",
-                colour=ctx.bot.embed_colour)
-
-            await menus.MenuPages(ctx.bot.utils.DiscordStatusSource([embed1, embed2, embed3], per_page=1), clear_reactions_after=True).start(ctx)
+        status = ctx.bot.discord_status
+        if status.updated_at is None:  # the poller hasn't finished its first poll yet
+            async with ctx.typing():
+                await status.poll(ctx.bot.http_client)
+        embeds = status.history_embeds if "-h" in flags or "--history" in flags else status.embeds
+        await menus.MenuPages(ctx.bot.utils.DiscordStatusSource(embeds, per_page=1), clear_reactions_after=True).start(ctx)
 
     @commands.guild_only()
     @commands.command(aliases=["perms"])
@@ -157,12 +124,10 @@ class Info(commands.Cog):
         `word` - The word to search up.
         """
         async with ctx.typing():
-            url = f"https://api.dictionaryapi.dev/api/v2/entries/en/{word}"
-            async with ctx.bot.session.get(url) as r:
-                response = await r.json()
-            if isinstance(response, dict):
+            entry = await ctx.bot.definitions.get(word)
+            if entry is None:
                 return await ctx.send("Sorry pal, I couldn't find definitions for the word you were looking for.")
-            await menus.MenuPages(ctx.bot.utils.DefineSource(response[0]["meanings"], response[0]), clear_reactions_after=True).start(ctx)
+            await menus.MenuPages(ctx.bot.utils.DefineSource(entry), clear_reactions_after=True).start(ctx)
 
     @commands.command(aliases=["ui"])
     async def userinfo(self, ctx, *, member: discord.Member = None):
@@ -17,6 +17,8 @@ import textwrap
 from config import config
 
 f = Figlet()
+MAX_PASTE_SIZE = 100_000  # 100kb
+MAX_OCR_SIZE = 4 * 1024 * 1024
 pytesseract.pytesseract.tesseract_cmd = config["tesseract_path"]
 
 
@@ -24,6 +26,20 @@ class Meta(commands.Cog):
     """
     Commands that don't belong to any specific category.
     """
+    @staticmethod
+    async def read_paste(ctx, text):
+        data = []
+        if text:
+            data.append(text)
+        if ctx.message.attachments:
+            data.append("\n\nATTACHMENTS\n\n")
+            remaining = MAX_PASTE_SIZE  # shared by every attachment
+            for attachment in ctx.message.attachments:
+                content = await ctx.bot.utils.fetch_attachment(ctx.bot.session, attachment, max_size=remaining, kind="text")
+                remaining -= len(content)
+                data.append(content.decode(encoding="utf-8", errors="replace"))
+        return "".join(data)
+
     @commands.command()
     async def mystbin(self, ctx, *, text=None):
         """
@@ -33,18 +49,7 @@ class Meta(commands.Cog):
         """
         if not text and not ctx.message.attachments:
             return await ctx.send("No text or text file provided.")
-        data = []
-        if text:
-            data.append(text)
-        if ctx.message.attachments:
-            data.append("\n\nATTACHMENTS\n\n")
-            for attachment in ctx.message.attachments:
-                if attachment.height or attachment.width:
-                    return await ctx.send("Only text files can be used.")
-                if attachment.size > 100_000:  # 100kb
-                    return await ctx.send("File is too large (>100kb).")
-                data.append((await attachment.read()).decode(encoding="utf-8"))
-        data = "".join(data)
+        data = await self.read_paste(ctx, text)
         embed = discord.Embed(
             title="Paste Successful!",
             description=f"[Click here to view]({await ctx.bot.mystbin(data)})",
@@ -61,18 +66,7 @@ class Meta(commands.Cog):
         """
         if not text and not ctx.message.attachments:
             return await ctx.send("No text or text file provided.")
-        data = []
-        if text:
-            data.append(text)
-        if ctx.message.attachments:
-            data.append("\n\nATTACHMENTS\n\n")
-            for attachment in ctx.message.attachments:
-                if attachment.height or attachment.width:
-                    return await ctx.send("Only text files can be used.")
-                if attachment.size > 100_000:  # 100kb
-                    return await ctx.send("File is too large (>100kb).")
-                data.append((await attachment.read()).decode(encoding="utf-8"))
-        data = "".join(data)
+        data = await self.read_paste(ctx, text)
         embed = discord.Embed(
             title="Paste Successful!",
             description=f"[Click here to view]({await ctx.bot.hastebin(data)})",
@@ -83,43 +77,44 @@ class Meta(commands.Cog):
     @commands.command()
     async def xkcd(self, ctx, query: typing.Union[int, str] = None):
         """
-        View comics from https://xkcd.com. Query by number or title.
+        View comics from https://xkcd.com. Query by number, title or alt text.
 
         `query` - The comic to search for. Defaults to a random number.
         """
-        async with ctx.typing():
-            if isinstance(query, str):
-                async with ctx.bot.session.get(
-                        "https://www.explainxkcd.com/wiki/api.php",
-                        params={"action": "query", "list": "search", "format": "json", "srsearch": query,
-                                "srwhat": "title", "srlimit": "max"}) as resp:
-                    r = await resp.json()
-                    if result := r["query"]["search"]:
-                        num = result[0]["title"].split(":")[0]
-                    else:
-                        return await ctx.send("Couldn't find a comic with that query.")
-            elif isinstance(query, int):
-                num = query
-            else:
-                async with ctx.bot.session.get("https://xkcd.com/info.0.json") as resp:
-                    max_num = (await resp.json())["num"]
-                num = random.randint(1, max_num)
-
-            async with ctx.bot.session.get(f"https://xkcd.com/{num}/info.0.json") as resp:
-                if resp.status in range(400, 500):
-                    return await ctx.send("Couldn't find a comic with that number.")
-                elif resp.status >= 500:
-                    return await ctx.send("Server error.")
-                data = await resp.json()
-
-            embed = discord.Embed(
-                title=f"{data['safe_title']} (Comic Number `{data['num']}`)",
-                description=data["alt"],
-                timestamp=datetime.datetime(year=int(data["year"]), month=int(data["month"]), day=int(data["day"])),
-                colour=ctx.bot.embed_colour)
-            embed.set_image(url=data["img"])
-            embed.set_footer(text="Created:")
-            await ctx.send(embed=embed)
+        index = ctx.bot.xkcd
+        if isinstance(query, str):
+            if not index:
+                return await ctx.send("The comic index is still being built, try again in a bit.")
+            comic = index.search(query)
+            if comic is None:
+                return await ctx.send("Couldn't find a comic with that query.")
+        elif isinstance(query, int):
+            comic = index.get(query)
+        else:
+            comic = index.random()
+
+        if comic is None:  # published since the last refresh, or the index is still being built
+            async with ctx.typing():
+                if query is None:
+                    latest = (await ctx.bot.http_client.get(
+                        "https://xkcd.com/info.0.json", ttl=60 * 60, stale_ttl=24 * 60 * 60)).json()["num"]
+                    query = random.randint(1, latest)
+                resp = await ctx.bot.http_client.get(f"https://xkcd.com/{query}/info.0.json", ttl=7 * 24 * 60 * 60,
+                                                     stale_ttl=30 * 24 * 60 * 60)
+            if resp.status in range(400, 500):
+                return await ctx.send("Couldn't find a comic with that number.")
+            elif resp.status >= 500:
+                return await ctx.send("Server error.")
+            comic = index.parse(resp.json())
+
+        embed = discord.Embed(
+            title=f"{comic['title']} (Comic Number `{comic['num']}`)",
+            description=comic["alt"],
+            timestamp=datetime.datetime.combine(comic["date"], datetime.time()),
+            colour=ctx.bot.embed_colour)
+        embed.set_image(url=comic["img"])
+        embed.set_footer(text="Created:")
+        await ctx.send(embed=embed)
 
     def _ocr(self, bytes_):
         img = cv2.imdecode(np.fromstring(bytes_, np.uint8), 1)
@@ -133,7 +128,8 @@ class Meta(commands.Cog):
         """
         if not ctx.message.attachments:
             return await ctx.send("No attachment provided.")
-        ocr_result = await ctx.bot.loop.run_in_executor(None, self._ocr, await ctx.message.attachments[0].read())
+        image = await ctx.bot.utils.fetch_attachment(ctx.bot.session, ctx.message.attachments[0], max_size=MAX_OCR_SIZE, kind="image")
+        ocr_result = await ctx.bot.loop.run_in_executor(None, self._ocr, image)
         await ctx.send(f"Text to image result for **{ctx.author}**\n```{ocr_result}```")
 
     @commands.command()
@@ -144,7 +140,7 @@ class Meta(commands.Cog):
         `text` - The text to convert to ascii.
         """
         char_list = textwrap.wrap(text, 25)
-        ascii_char_list = [f.renderText(char) for char in char_list]
+        ascii_char_list = await ctx.bot.loop.run_in_executor(None, lambda: [f.renderText(char) for char in char_list])
         await menus.MenuPages(source=ctx.bot.utils.PaginatorSource(ascii_char_list, per_page=1), delete_message_after=True).start(ctx)
 
     # @bot.beta_command()
@@ -226,14 +222,13 @@ class Meta(commands.Cog):
         if not tasks:
             return await ctx.send(f"{ctx.bot.emoji_dict['red_tick']} Your todo list is empty.")
         # try with number
-        try:
-            task = tasks[int(task) - 1]
-            await ctx.bot.cache.remove_todo(ctx.author.id, task)
-        except (IndexError, ValueError):
-            # try with name
-            if task not in tasks:
-                return await ctx.send(f"{ctx.bot.emoji_dict['red_tick']} Couldn't find a task with that name or number.")
+        if task.isdigit() and 0 < int(task) <= len(tasks):
+            task = await ctx.bot.cache.remove_todo_at(ctx.author.id, int(task))
+        # try with name
+        elif task in tasks:
             await ctx.bot.cache.remove_todo(ctx.author.id, task)
+        else:
+            return await ctx.send(f"{ctx.bot.emoji_dict['red_tick']} Couldn't find a task with that name or number.")
 
         await ctx.send(f"{ctx.bot.emoji_dict['green_tick']} Removed `{task}` from your todo list.")
 
@@ -116,8 +116,14 @@ class Music(commands.Cog):
 
         CustomContext.player = get_player
         self.bot = bot
+        self.searches = bot.utils.SingleFlight()
         bot.loop.create_task(self.start_nodes())
 
+    async def search_tracks(self, query: str):
+        # identical searches made at the same time share one lavalink request
+        key = " ".join(query.split()).casefold()
+        return await self.searches.do(key, self.bot.wavelink.get_tracks, f"ytsearch:{query}")
+
     async def cog_check(self, ctx):
         if not ctx.guild:
             raise commands.NoPrivateMessage
@@ -209,7 +215,7 @@ class Music(commands.Cog):
 
         `query` - The song to remove from the queue.
         """
-        query_results = await ctx.bot.wavelink.get_tracks(f"ytsearch:{query}")
+        query_results = await self.search_tracks(query)
         if not query_results:
             return await ctx.send(f"Could not find any songs with that query.")
         track = Track(query_results[0].id, query_results[0].info, requester=ctx.author)
@@ -230,7 +236,7 @@ class Music(commands.Cog):
         if len(ctx.player.queue) >= 100:
             return await ctx.send("Sorry, only `100` songs can be in the queue at a time.")
 
-        query_results = await ctx.bot.wavelink.get_tracks(f"ytsearch:{query}")
+        query_results = await self.search_tracks(query)
         if not query_results:
             return await ctx.send(f"Could not find any songs with that query.")
 
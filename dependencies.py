@@ -2,20 +2,57 @@ import discord
 from discord.ext import commands, tasks
 import datetime
 import aiohttp
+from aiohttp import web
 import wavelink
 import os
 import re
 import asyncio
+import time
 from config import config
 import asyncpg
 import utils
-from collections import Counter
-import json
+from collections import Counter, defaultdict
+import uuid
 import aioredis
 from copy import deepcopy
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+import psutil
+import logging
+import traceback
+
+log = logging.getLogger(__name__)
 
 EMPTY_GUILD_CACHE = {"prefixes": []}
-EMPTY_TODO = []
+DEFAULT_GUILD_INFO = MappingProxyType({"prefixes": ()})
+EMPTY_TODO = ()
+DEFAULT_PREFIX_MATCHER = utils.compile_prefixes(["pb"])
+DEFAULT_PASTE_BACKENDS = {"mystbin": "https://mystb.in", "hastebin": "https://hastebin.com"}
+STATS_BUCKET_TTL = 8 * 24 * 60 * 60  # a bit more than the largest window
+STATS_WINDOWS = {"1h": 1, "24h": 24, "7d": 7 * 24}
+TOP_USERS_KEYS = ("top_users_overall", "top_users_overall:errors", "top_users_overall:total")
+# adds exact counts to the Space-Saving counter kept in redis as a zset of counts, a hash of errors and the total.
+# once the counter is full a new key replaces the smallest one and inherits its count as error.
+SPACE_SAVING_ADD = """
+local capacity = tonumber(ARGV[1])
+for i = 2, #ARGV, 2 do
+    local key, count = ARGV[i], tonumber(ARGV[i + 1])
+    redis.call("INCRBY", KEYS[3], count)
+    if redis.call("ZSCORE", KEYS[1], key) then
+        redis.call("ZINCRBY", KEYS[1], count, key)
+    else
+        local error = 0
+        if redis.call("ZCARD", KEYS[1]) >= capacity then
+            local smallest = redis.call("ZRANGE", KEYS[1], 0, 0, "WITHSCORES")
+            redis.call("ZREM", KEYS[1], smallest[1])
+            redis.call("HDEL", KEYS[2], smallest[1])
+            error = tonumber(smallest[2])
+        end
+        redis.call("ZADD", KEYS[1], error + count, key)
+        redis.call("HSET", KEYS[2], key, error)
+    end
+end
+"""
 
 
 async def get_prefix(bot, message: discord.Message):
@@ -23,16 +60,12 @@ async def get_prefix(bot, message: discord.Message):
     Get prefix function.
     """
     if not message.guild:
-        prefixes = ["pb"]
+        matcher = DEFAULT_PREFIX_MATCHER
     else:
-        prefixes = (await bot.cache.get_guild_info(message.guild.id))["prefixes"]
-        if not prefixes:  # couldn't find it or no prefixes
-            prefixes = ["pb"]
-    prefixes = sorted(prefixes, key=len)
-    for prefix in prefixes:
-        match = re.match(f"^({prefix}\s*).*", message.content, flags=re.IGNORECASE)
-        if match:
-            return match.group(1)
+        matcher = bot.cache.get_prefix_matcher(message.guild.id)
+    match = matcher.match(message.content)
+    if match:
+        return match.group(0)
     # fallback
     return commands.when_mentioned(bot, message)
 
@@ -54,18 +87,41 @@ class PB_Bot(commands.Bot):
         self._BotBase__cogs = commands.core._CaseInsensitiveDict()
 
         self.start_time = datetime.datetime.now()
-        self.session = aiohttp.ClientSession()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=30, connect=5, sock_read=15))
         self.wavelink = wavelink.Client(bot=self)
         self.coglist = [f"cogs.{item[:-3]}" for item in os.listdir("cogs") if item != "__pycache__"] + ["jishaku"]
 
         self.pool = asyncio.get_event_loop().run_until_complete(asyncpg.create_pool(**config["postgresql"]))
         self.redis = asyncio.get_event_loop().run_until_complete(aioredis.create_redis_pool(config["redis"]))
+        self.http_client = utils.HTTPClient(
+            self.session,
+            cache=utils.ResponseCache(config.get("http_cache_size", 2048),
+                                      redis=self.redis if config.get("http_cache_redis", True) else None),
+            host_limits=config.get("http_host_limits"))
 
         self.utils = utils
         self.command_list = []
         self.embed_colour = 0x01ad98
 
         self.cache = Cache(self)
+        self.xkcd = utils.XkcdIndex()
+        self.discord_status = utils.DiscordStatus(self.embed_colour)
+        self.definitions = utils.DefinitionStore(self.pool, self.http_client,
+                                                 cache_size=config.get("definition_cache_size", 4096))
+        self.reddit = utils.RedditBuffers(self.http_client, maxsize=config.get("reddit_buffer_size", 256))
+        self.paste = utils.PasteClient(
+            self.http_client,
+            [utils.PasteBackend(name, url) for name, url in config.get("paste_backends", DEFAULT_PASTE_BACKENDS).items()],
+            redis=self.redis,
+            timeout=config.get("paste_timeout", 10))
+
+        self.executor = ThreadPoolExecutor()
+        self.loop.set_default_executor(self.executor)
+        self.process = psutil.Process()
+        self.metrics_runner = None
+        self.stall_detector = utils.StallDetector(self.loop, threshold=config.get("stall_threshold", 0.25))
 
         self.github_url = "https://github.com/PB4162/PB-Bot"
         self.invite_url = discord.utils.oauth_url("719907834120110182", permissions=discord.Permissions(104189127))
@@ -157,33 +213,190 @@ class PB_Bot(commands.Bot):
     async def before_presence(self):
         await self.wait_until_ready()
 
-    @tasks.loop(hours=24)
-    async def clear_cmd_stats(self):
-        await self.cache.clear_cmd_stats()
+    @tasks.loop(hours=1)
+    async def archive_cmd_stats(self):
+        # the last hourly bucket of a day can still receive pushes shortly after midnight
+        yesterday = (datetime.datetime.utcnow() - datetime.timedelta(hours=1)).date() - datetime.timedelta(days=1)
+        try:
+            await self.cache.archive_cmd_stats(yesterday)
+        except Exception:
+            log.exception("Failed to archive the command stats for %s", yesterday)
+
+    @tasks.loop(seconds=config.get("cache_flush_interval", 60))
+    async def flush_cache(self):
+        try:
+            await asyncio.wait_for(self.cache.flush(), timeout=config.get("cache_flush_timeout", 30))
+        except asyncio.TimeoutError:  # the dirty rows are kept for the next flush
+            log.warning("Cache flush timed out, %s row(s) still dirty", sum(len(keys) for keys in self.cache.dirty.values()))
+        except Exception:
+            log.exception("Cache flush failed, %s row(s) still dirty", sum(len(keys) for keys in self.cache.dirty.values()))
+
+    @tasks.loop(seconds=config.get("error_flush_interval", 10))
+    async def flush_errors(self):
+        try:
+            await self.cache.flush_errors()
+        except Exception:  # the batch is kept for the next flush
+            log.exception("Failed to flush %s error fingerprint(s)", len(self.cache.error_queue))
+
+    @tasks.loop(hours=1)
+    async def refresh_xkcd(self):
+        try:
+            if added := await self.xkcd.refresh(self.pool, self.http_client):
+                log.info("Indexed %s new xkcd comic(s)", added)
+        except Exception:
+            log.exception("Failed to refresh the xkcd index")
 
-    @clear_cmd_stats.before_loop
-    async def clear_command_stats_before(self):
-        # wait until midnight to start the loop
-        tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
-        midnight = datetime.datetime(year=tomorrow.year, month=tomorrow.month, day=tomorrow.day)
-        dt = midnight - datetime.datetime.now()
-        await asyncio.sleep(dt.total_seconds())
+    @tasks.loop(seconds=config.get("discord_status_interval", 60))
+    async def poll_discord_status(self):
+        try:
+            changes = await self.discord_status.poll(self.http_client)
+        except Exception:
+            log.exception("Failed to poll the discord status")
+            return
+        if changes:
+            self.dispatch("discord_status_change", changes)
+
+    @tasks.loop(minutes=5)
+    async def refresh_reddit(self):
+        await self.reddit.refresh_hot(config.get("reddit_hot_draws", 5))
 
     @tasks.loop(minutes=5)
     async def dump_cmd_stats(self):
-        await self.cache.dump_cmd_stats()
+        try:
+            await self.cache.dump_cmd_stats()
+        except Exception:  # the pending batch is retried on the next dump
+            log.exception("Failed to push the command stats to redis")
+
+    async def invoke(self, ctx):
+        # on_command is dispatched as a task, so it only runs once the command first yields
+        ctx.invoked_at = time.perf_counter()
+        await super().invoke(ctx)
 
     async def on_command(self, ctx):
-        self.cache.command_stats["top_commands_today"].update({ctx.command.qualified_name: 1})
-        self.cache.command_stats["top_commands_overall"].update({ctx.command.qualified_name: 1})
+        self.cache.record_command(ctx.command.qualified_name, str(ctx.author.id))
 
-        self.cache.command_stats["top_users_today"].update({str(ctx.author.id): 1})
-        self.cache.command_stats["top_users_overall"].update({str(ctx.author.id): 1})
+    async def on_command_completion(self, ctx):
+        self.cache.record_latency(ctx.command.qualified_name, time.perf_counter() - ctx.invoked_at)
+
+    async def on_command_error(self, ctx, error):
+        # the ErrorHandling cog deals with the error itself
+        # only errors raised by the callback count, checks, cooldowns and conversion fail before it runs
+        if isinstance(error, commands.CommandInvokeError) and ctx.invoked_at is not None:
+            self.cache.record_latency(ctx.command.qualified_name, time.perf_counter() - ctx.invoked_at)
 
     async def close(self):
+        self.stall_detector.stop()
         await self.cache.dump_all()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
         await super().close()
 
+    def collect_metrics(self):
+        """
+        Returns the bot's metrics in the prometheus text format.
+        """
+        metrics = utils.MetricsWriter()
+
+        metrics.add("pb_commands_total", "counter", "Commands invoked since the last restart.",
+                    [({"command": name}, count) for name, count in self.cache.command_invocations.items()])
+        latencies = self.cache.command_latencies.items()
+        metrics.add("pb_command_latency_seconds", "summary", "Time from invoking a command to it finishing.",
+                    [({"command": name, "quantile": quantile}, value)
+                     for name, histogram in latencies
+                     for quantile, value in zip(("0.5", "0.95", "0.99", "1"), histogram.summary())])
+
+        metrics.add("pb_postgres_pool_connections", "gauge", "Connections in the asyncpg pool.",
+                    [({"state": "open"}, self.pool.get_size()),
+                     ({"state": "in_use"}, self.pool.get_size() - self.pool.get_idle_size())])
+        redis_pool = self.redis.connection
+        metrics.add("pb_redis_pool_connections", "gauge", "Connections in the redis pool.",
+                    [({"state": "open"}, redis_pool.size),
+                     ({"state": "in_use"}, redis_pool.size - redis_pool.freesize)])
+
+        todos = self.cache.todos
+        metrics.add("pb_cache_entries", "gauge", "Entries held by the cache.",
+                    [({"cache": "guild_info"}, len(self.cache.guild_cache)),
+                     ({"cache": "prefix_matchers"}, len(self.cache.prefix_matchers)),
+                     ({"cache": "todos"}, len(todos)),
+                     ({"cache": "unflushed_todos"}, len(self.cache.unflushed_todos)),
+                     ({"cache": "xkcd"}, len(self.xkcd)),
+                     ({"cache": "reddit"}, len(self.reddit.buffers)),
+                     ({"cache": "definitions"}, len(self.definitions.entries)),
+                     ({"cache": "top_users"}, len(self.cache.command_stats["top_users_overall"]))])
+        metrics.add("pb_top_users_error_bound", "gauge", "Most that a tracked user's command count can be overestimated by.",
+                    self.cache.command_stats["top_users_overall"].error_bound)
+        reddit = self.reddit.buffers
+        definitions = self.definitions.entries
+        metrics.add("pb_cache_requests_total", "counter", "Lookups in the todo, reddit and definition LRUs.",
+                    [({"cache": "todos", "result": "hit"}, todos.hits),
+                     ({"cache": "todos", "result": "miss"}, todos.misses),
+                     ({"cache": "reddit", "result": "hit"}, reddit.hits),
+                     ({"cache": "reddit", "result": "miss"}, reddit.misses),
+                     ({"cache": "definitions", "result": "hit"}, definitions.hits),
+                     ({"cache": "definitions", "result": "miss"}, definitions.misses)])
+        metrics.add("pb_cache_evictions_total", "counter", "Entries evicted from the todo LRU.",
+                    [({"cache": "todos"}, todos.evictions)])
+        if self.cache.last_flush is not None:
+            metrics.add("pb_cache_last_flush_rows", "gauge", "Rows written by the last cache flush.",
+                        self.cache.last_flush["rows"])
+            metrics.add("pb_cache_last_flush_seconds", "gauge", "Duration of the last cache flush.",
+                        self.cache.last_flush["elapsed"])
+
+        metrics.add("pb_errors_queued", "gauge", "Error fingerprints waiting to be flushed.", len(self.cache.error_queue))
+        metrics.add("pb_errors_dropped_total", "counter", "Errors dropped because the queue was full.",
+                    self.cache.dropped_errors)
+
+        hosts = self.http_client.stats.items()
+        metrics.add("pb_http_responses_total", "counter", "Responses from external APIs.",
+                    [({"host": host, "status": status}, count)
+                     for host, stats in hosts for status, count in stats["responses"].items()])
+        metrics.add("pb_http_errors_total", "counter", "Requests to external APIs that failed without a response.",
+                    [({"host": host, "error": error}, count)
+                     for host, stats in hosts for error, count in stats["errors"].items()])
+        metrics.add("pb_http_retries_total", "counter", "Retried requests to external APIs.",
+                    [({"host": host}, stats["retries"]) for host, stats in hosts])
+        metrics.add("pb_http_cache_requests_total", "counter", "Cached GETs to external APIs by result (hit, stale or miss).",
+                    [({"host": host, "result": result}, count)
+                     for host, stats in hosts for result, count in stats["cache"].items()])
+        metrics.add("pb_http_cache_hit_ratio", "gauge", "Share of cached GETs served from the cache, stale ones included.",
+                    [({"host": host}, (stats["cache"]["hit"] + stats["cache"]["stale"]) / sum(stats["cache"].values()))
+                     for host, stats in hosts if stats["cache"]])
+        metrics.add("pb_http_request_latency_seconds", "summary", "Latency of requests to external APIs.",
+                    [({"host": host, "quantile": quantile}, value)
+                     for host, stats in hosts
+                     for quantile, value in zip(("0.5", "0.95", "0.99", "1"), stats["latency"].summary())])
+
+        coalesced = [({"call": "http"}, self.http_client.inflight.coalesced)]
+        if (music := self.get_cog("Music")) is not None:
+            coalesced.append(({"call": "track_search"}, music.searches.coalesced))
+        metrics.add("pb_coalesced_calls_total", "counter", "Calls that shared an identical call already in flight.", coalesced)
+
+        metrics.add("pb_wavelink_players", "gauge", "Music players.",
+                    sum(len(node.players) for node in self.wavelink.nodes.values()))
+        metrics.add("pb_executor_queue_depth", "gauge", "Jobs waiting for a thread in the default executor.",
+                    self.executor._work_queue.qsize())
+        metrics.add("pb_gateway_latency_seconds", "gauge", "Websocket heartbeat latency.", self.latency)
+        metrics.add("pb_event_loop_lag_seconds", "gauge", "How late the last event loop heartbeat ran.", self.stall_detector.lag)
+        metrics.add("pb_event_loop_stalls_total", "counter", "Times the event loop was blocked for longer than the threshold.",
+                    self.stall_detector.stall_count)
+        metrics.add("pb_guilds", "gauge", "Guilds the bot is in.", len(self.guilds))
+
+        cpu = self.process.cpu_times()
+        metrics.add("process_cpu_seconds_total", "counter", "User and system CPU time.", cpu.user + cpu.system)
+        metrics.add("process_resident_memory_bytes", "gauge", "Resident memory size.", self.process.memory_info().rss)
+        return metrics.render()
+
+    async def metrics_handler(self, _):
+        return web.Response(text=self.collect_metrics(), content_type="text/plain", charset="utf-8")
+
+    async def start_metrics_server(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics_handler)
+        self.metrics_runner = web.AppRunner(app, access_log=None)
+        await self.metrics_runner.setup()
+        site = web.TCPSite(self.metrics_runner, config["metrics"].get("host", "127.0.0.1"), config["metrics"].get("port", 9100))
+        await site.start()
+
     async def schemas(self):
         with open("schemas.sql") as f:
             await self.pool.execute(f.read())
@@ -194,6 +407,9 @@ class PB_Bot(commands.Bot):
 
         self.loop.run_until_complete(self.schemas())
         self.loop.run_until_complete(self.cache.load_all())
+        self.loop.run_until_complete(self.xkcd.load(self.pool))
+        if "metrics" in config:  # opt-in
+            self.loop.run_until_complete(self.start_metrics_server())
 
         for command in self.commands:
             self.command_list.append(str(command))
@@ -211,18 +427,22 @@ class PB_Bot(commands.Bot):
                                     self.command_list.append(str(subcommand3))
                                     self.command_list.extend([f"{subcommand2} {subcommand3_alias}" for subcommand3_alias in subcommand3.aliases])
 
+        self.stall_detector.start()
         self.presence_update.start()
+        self.flush_cache.start()
         self.dump_cmd_stats.start()
-        self.clear_cmd_stats.start()
+        self.archive_cmd_stats.start()
+        self.flush_errors.start()
+        self.refresh_xkcd.start()
+        self.refresh_reddit.start()
+        self.poll_discord_status.start()
         super().run(*args, **kwargs)
 
     async def mystbin(self, data):
-        async with self.session.post("https://mystb.in/documents", data=data) as r:
-            return f"https://mystb.in/{(await r.json())['key']}"
+        return await self.paste.paste(data, prefer="mystbin")
 
     async def hastebin(self, data):
-        async with self.session.post("https://hastebin.com/documents", data=data) as r:
-            return f"https://hastebin.com/{(await r.json())['key']}"
+        return await self.paste.paste(data, prefer="hastebin")
 
 
 class Cache:
@@ -230,159 +450,430 @@ class Cache:
         self.bot = bot
 
         self.guild_cache = {}
-        self.command_stats = {"top_commands_today": Counter(), "top_commands_overall": Counter(),
-                              "top_users_today": Counter(), "top_users_overall": Counter()}
-        self.todos = {}
+        self.prefix_matchers = {}
+        top_users = utils.SpaceSaving.from_error(config.get("top_users_error", 0.001))
+        self.top_users_capacity = top_users.capacity
+        self.command_stats = {"top_commands_overall": Counter(), "top_users_overall": top_users}
+        self.stats_deltas = defaultdict(Counter)  # {redis key: deltas}, not pushed to redis yet
+        self.pending_stats = None  # (batch_id, deltas) of a push that may or may not have gone through
+        self.todos = utils.LRUCache(config.get("todo_cache_size", 10_000), on_evict=self.on_todo_evict)
+        self.unflushed_todos = {}
+        self.todo_loads = {}
+
+        self.dirty = {"guild_info": set(), "todos": {}}  # todos: {user_id: {position, ...}}
+        self.flushing = None  # the dirty sets being written by a flush in progress
+        self.last_flush = None
+
+        self.command_invocations = Counter()  # since the last restart, unlike top_commands_overall
+        self.command_latencies = {}
+        self.overall_latency = utils.LatencyHistogram()
+
+        self.error_queue = {}  # {fingerprint: row}, not flushed to postgres yet
+        self.error_queue_size = config.get("error_queue_size", 1000)
+        self.dropped_errors = 0
 
     async def load_all(self):
         await self.load_guild_info()
         await self.load_cmd_stats()
-        await self.load_todos()
 
     async def dump_all(self):
-        await self.dump_guild_info()
+        await self.flush()
+        await self.flush_errors()
         await self.dump_cmd_stats()
-        await self.dump_todos()
 
     # guild info
 
     async def load_guild_info(self):
+        # rows are only kept for guilds with non-default settings
+        await self.bot.pool.execute("DELETE FROM guild_info WHERE prefixes = '{}'")
         data = await self.bot.pool.fetch("SELECT * FROM guild_info")
         for entry in data:
             self.guild_cache[entry["guild_id"]] = {k: v for k, v in list(entry.items())[1:]}  # skip the guild_id
-
-    async def dump_guild_info(self):
-        items = deepcopy(self.guild_cache).items()
-        for guild_id, data in items:
-            await self.bot.pool.execute("UPDATE guild_info SET prefixes = $1 WHERE guild_id = $2", data["prefixes"], guild_id)
-            # idk how to make this dynamic
-
-    async def create_guild_info(self, guild_id):
-        await self.bot.pool.execute("INSERT INTO guild_info VALUES ($1)", guild_id)
-        self.guild_cache[guild_id] = deepcopy(EMPTY_GUILD_CACHE)
-        return self.guild_cache[guild_id]
+            self.build_prefix_matcher(entry["guild_id"])
 
     async def delete_guild_info(self, guild_id):
-        await self.bot.pool.execute("DELETE FROM guild_info WHERE guild_id = $1", guild_id)
-        self.guild_cache.pop(guild_id, None)
+        if self.guild_cache.pop(guild_id, None) is None:  # nothing stored for this guild
+            return
+        self.prefix_matchers.pop(guild_id, None)
+        self.dirty["guild_info"].add(guild_id)
 
     async def get_guild_info(self, guild_id):
-        info = self.guild_cache.get(guild_id, None)
-        if info is None:
-            return await self.create_guild_info(guild_id)
-        return info
-
-    async def cleanup_guild_info(self, guild_id):
-        cache = await self.get_guild_info(guild_id)
-        if cache == EMPTY_GUILD_CACHE:
-            await self.delete_guild_info(guild_id)
+        """
+        Returns the settings for a guild. Guilds with default settings share a read-only mapping.
+        """
+        return self.guild_cache.get(guild_id, DEFAULT_GUILD_INFO)
+
+    def build_prefix_matcher(self, guild_id):
+        prefixes = self.guild_cache.get(guild_id, DEFAULT_GUILD_INFO)["prefixes"]
+        if not prefixes:
+            self.prefix_matchers.pop(guild_id, None)
+        else:
+            self.prefix_matchers[guild_id] = utils.compile_prefixes(prefixes)
+
+    def get_prefix_matcher(self, guild_id):
+        # guilds without custom prefixes never get a matcher of their own
+        return self.prefix_matchers.get(guild_id, DEFAULT_PREFIX_MATCHER)
 
     async def add_prefix(self, guild_id, prefix):
-        await self.bot.pool.execute("UPDATE guild_info SET prefixes = array_append(prefixes, $1) WHERE guild_id = $2", prefix, guild_id)
-        (await self.get_guild_info(guild_id))["prefixes"].append(prefix)
+        self.guild_cache.setdefault(guild_id, deepcopy(EMPTY_GUILD_CACHE))["prefixes"].append(prefix)
+        self.build_prefix_matcher(guild_id)
+        self.dirty["guild_info"].add(guild_id)
 
     async def remove_prefix(self, guild_id, prefix):
-        await self.bot.pool.execute("UPDATE guild_info SET prefixes = array_remove(prefixes, $1) WHERE guild_id = $2", prefix, guild_id)
-        (await self.get_guild_info(guild_id))["prefixes"].remove(prefix)
-
-        await self.cleanup_guild_info(guild_id)
+        prefixes = (await self.get_guild_info(guild_id))["prefixes"]
+        if prefixes == [prefix]:  # last prefix, the row would be empty
+            return await self.delete_guild_info(guild_id)
+        prefixes.remove(prefix)
+        self.build_prefix_matcher(guild_id)
+        self.dirty["guild_info"].add(guild_id)
 
     async def clear_prefixes(self, guild_id):
-        await self.bot.pool.execute("UPDATE guild_info SET prefixes = '{}' WHERE guild_id = $1", guild_id)
-        (await self.get_guild_info(guild_id))["prefixes"].clear()
-
-        await self.cleanup_guild_info(guild_id)
+        await self.delete_guild_info(guild_id)
 
     # command stats
 
+    def record_command(self, command, user_id):
+        hour = datetime.datetime.utcnow().strftime("%Y%m%d%H")
+        self.command_invocations[command] += 1
+        self.command_stats["top_commands_overall"].update({command: 1})
+        self.command_stats["top_users_overall"].update({user_id: 1})
+        for key, field in (("top_commands_overall", command), ("top_users_overall", user_id),
+                           (f"stats:cmd:{hour}", command), (f"stats:user:{hour}", user_id)):
+            self.stats_deltas[key][field] += 1
+
     async def load_cmd_stats(self):
-        top_cmds_today = await self.bot.redis.hgetall("top_commands_today", encoding="utf-8")
-        top_users_today = await self.bot.redis.hgetall("top_users_today", encoding="utf-8")
-        top_cmds_overall = await self.bot.redis.hgetall("top_commands_overall", encoding="utf-8")
-        top_users_overall = await self.bot.redis.hgetall("top_users_overall", encoding="utf-8")
-        self.command_stats["top_commands_today"].update({k: int(v) for k, v in top_cmds_today.items()})
-        self.command_stats["top_users_today"].update({k: int(v) for k, v in top_users_today.items()})
-        self.command_stats["top_commands_overall"].update({k: int(v) for k, v in top_cmds_overall.items()})
-        self.command_stats["top_users_overall"].update({k: int(v) for k, v in top_users_overall.items()})
+        # "today" stats are served from the hourly buckets now
+        await self.bot.redis.delete("top_commands_today", "top_users_today")
+        # user stats used to be stored as a hash
+        if await self.bot.redis.type("top_users_overall") == b"hash":
+            old = utils.SpaceSaving.deserialize(
+                self.top_users_capacity, await self.bot.redis.hgetall("top_users_overall", encoding="utf-8"))
+            tr = self.bot.redis.multi_exec()
+            tr.delete(*TOP_USERS_KEYS)
+            if old.counts:
+                tr.zadd("top_users_overall", *[item for user_id, count in old.counts.items() for item in (count, user_id)])
+                tr.hmset_dict("top_users_overall:errors", old.errors)
+            tr.set("top_users_overall:total", old.total)
+            await tr.execute()
+        # user stats used to be trimmed without keeping the errors or the total
+        if not await self.bot.redis.exists("top_users_overall:total"):
+            users = await self.bot.redis.zrange("top_users_overall", 0, -1, withscores=True)
+            await self.bot.redis.set("top_users_overall:total", int(sum(count for _, count in users)),
+                                     exist=self.bot.redis.SET_IF_NOT_EXIST)
+        await self.refresh_cmd_stats()
+
+    async def refresh_cmd_stats(self):
+        """
+        Rebuilds the local stats from the totals in redis and anything that hasn't been pushed yet.
+        """
+        tr = self.bot.redis.multi_exec()
+        tr.hgetall("top_commands_overall", encoding="utf-8")
+        tr.zrevrange("top_users_overall", 0, -1, withscores=True, encoding="utf-8")
+        tr.hgetall("top_users_overall:errors", encoding="utf-8")
+        tr.get("top_users_overall:total")
+        commands_, users, errors, total = await tr.execute()
+
+        commands_ = Counter({k: int(v) for k, v in commands_.items()})
+        users = utils.SpaceSaving.deserialize(self.top_users_capacity, dict(users), errors=errors,
+                                              total=int(total) if total is not None else None)
+        for deltas in [self.stats_deltas] + ([self.pending_stats[1]] if self.pending_stats else []):
+            commands_.update(deltas.get("top_commands_overall", {}))
+            users.update(deltas.get("top_users_overall", {}))
+        self.command_stats["top_commands_overall"] = commands_
+        self.command_stats["top_users_overall"] = users
 
     async def dump_cmd_stats(self):
-        top_cmds_today = dict(self.command_stats["top_commands_today"])
-        top_users_today = dict(self.command_stats["top_users_today"])
-        top_cmds_overall = dict(self.command_stats["top_commands_overall"])
-        top_users_overall = dict(self.command_stats["top_users_overall"])
-        if top_cmds_today:  # will error if it's empty
-            await self.bot.redis.hmset_dict("top_commands_today", top_cmds_today)
-        if top_users_today:
-            await self.bot.redis.hmset_dict("top_users_today", top_users_today)
-        if top_cmds_overall:
-            await self.bot.redis.hmset_dict("top_commands_overall", top_cmds_overall)
-        if top_users_overall:
-            await self.bot.redis.hmset_dict("top_users_overall", top_users_overall)
-
-    async def clear_cmd_stats(self):
-        # dump
-        yesterday = datetime.date.today() - datetime.timedelta(days=1)
-        cmds = json.dumps(dict(self.command_stats["top_commands_today"]))
-        users = json.dumps(dict(self.command_stats["top_users_today"]))
-        await self.bot.pool.execute("INSERT INTO command_stats VALUES ($1, $2, $3)", yesterday, cmds, users)
-
-        # clear
-        self.command_stats["top_commands_today"].clear()
-        self.command_stats["top_users_today"].clear()
+        """
+        Adds the stats collected since the last dump to the totals and hourly buckets in redis.
+        """
+        if self.pending_stats is None:
+            if not self.stats_deltas:
+                return
+            self.pending_stats = (uuid.uuid4().hex, self.stats_deltas)
+            self.stats_deltas = defaultdict(Counter)
+        batch_id, deltas = self.pending_stats
+        marker = f"stats:pushed:{batch_id}"
+
+        # if a previous attempt failed after reaching redis, the marker stops it from being counted twice
+        if not await self.bot.redis.exists(marker):
+            tr = self.bot.redis.multi_exec()
+            for key, delta in deltas.items():
+                if key == "top_users_overall":
+                    tr.eval(SPACE_SAVING_ADD, keys=list(TOP_USERS_KEYS),
+                            args=[self.top_users_capacity, *[item for field, count in delta.items() for item in (field, count)]])
+                    continue
+                for field, count in delta.items():
+                    if key == "top_commands_overall":
+                        tr.hincrby(key, field, count)
+                    else:
+                        tr.zincrby(key, count, field)
+                if key.startswith("stats:"):
+                    tr.expire(key, STATS_BUCKET_TTL)
+            tr.set(marker, 1, expire=86400)
+            await tr.execute()
+        self.pending_stats = None
+        await self.refresh_cmd_stats()
+
+    async def union_buckets(self, hours: list, *, limit: int = None, local: dict = None):
+        """
+        Combines the hourly buckets for the given hours and returns the top commands and top users (all of them if no limit is given).
+        `local` holds counts that haven't been pushed yet as `{"cmd": Counter, "user": Counter}`.
+        """
+        local = local or {}
+        tr = self.bot.redis.multi_exec()
+        for kind in ("cmd", "user"):
+            dest = f"stats:union:{kind}"  # safe to share, the transaction is atomic
+            tr.zunionstore(dest, *[f"stats:{kind}:{hour}" for hour in hours])
+            tr.zrevrange(dest, 0, -1 if limit is None else limit - 1, withscores=True, encoding="utf-8")
+            for member in local.get(kind, ()):
+                tr.zscore(dest, member)
+            tr.delete(dest)
+        results = iter(await tr.execute())
+
+        tops = []
+        for kind in ("cmd", "user"):
+            next(results)
+            top = Counter({k: int(v) for k, v in next(results)})
+            for member, count in local.get(kind, {}).items():
+                # members outside the limit can only move up by their local count, so this is still exact
+                top[member] = int(next(results) or 0) + count
+            next(results)
+            tops.append(top.most_common(limit))
+        return tops[0], tops[1]
+
+    async def get_window_stats(self, window: str):
+        """
+        Returns the top 5 commands and users over a window in `STATS_WINDOWS`, including the current partial hour.
+        Windows shorter than a day include the previous hour too, so they are never empty right after the hour changes.
+        """
+        now = datetime.datetime.utcnow()
+        size = STATS_WINDOWS[window]
+        hours = [(now - datetime.timedelta(hours=i)).strftime("%Y%m%d%H") for i in range(size + 1 if size < 24 else size)]
+        local = {"cmd": Counter(), "user": Counter()}
+        for deltas in [self.stats_deltas] + ([self.pending_stats[1]] if self.pending_stats else []):
+            for hour in hours:
+                local["cmd"].update(deltas.get(f"stats:cmd:{hour}", {}))
+                local["user"].update(deltas.get(f"stats:user:{hour}", {}))
+        return await self.union_buckets(hours, limit=5, local=local)
+
+    async def archive_cmd_stats(self, date: datetime.date):
+        """
+        Saves a day's stats to postgres. Only the first process to get here archives each day.
+        """
+        if not await self.bot.redis.set(f"stats:archived:{date:%Y%m%d}", 1, expire=STATS_BUCKET_TTL,
+                                        exist=self.bot.redis.SET_IF_NOT_EXIST):
+            return
+        try:
+            await self.write_archive(date)
+        except BaseException:  # let the next run (or another process) try again
+            await self.bot.redis.delete(f"stats:archived:{date:%Y%m%d}")
+            raise
+
+    async def write_archive(self, date: datetime.date):
+        top_commands, top_users = await self.union_buckets([f"{date:%Y%m%d}{hour:02}" for hour in range(24)])
+        async with self.bot.pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute("""INSERT INTO daily_command_stats (date, command, uses)
+                SELECT $1, * FROM unnest($2::text[], $3::bigint[])
+                ON CONFLICT (date, command) DO UPDATE SET uses = EXCLUDED.uses""",
+                                         date, [k for k, _ in top_commands], [v for _, v in top_commands])
+                await connection.execute("""INSERT INTO daily_user_stats (date, user_id, uses)
+                SELECT $1, * FROM unnest($2::bigint[], $3::bigint[])
+                ON CONFLICT (date, user_id) DO UPDATE SET uses = EXCLUDED.uses""",
+                                         date, [int(k) for k, _ in top_users], [v for _, v in top_users])
+
+    # latency
+
+    def record_latency(self, command, seconds):
+        histogram = self.command_latencies.get(command, None)
+        if histogram is None:
+            histogram = self.command_latencies[command] = utils.LatencyHistogram()
+        histogram.record(seconds)
+        self.overall_latency.record(seconds)
+
+    # errors
+
+    def record_error(self, error: BaseException, message: str, command: str):
+        """
+        Queues an error to be flushed, merging it with queued errors that have the same fingerprint.
+        """
+        fingerprint = utils.error_fingerprint(error)
+        now = datetime.datetime.utcnow()
+        entry = self.error_queue.get(fingerprint)
+        if entry is None:
+            if len(self.error_queue) >= self.error_queue_size:
+                self.dropped_errors += 1
+                return
+            entry = self.error_queue[fingerprint] = {
+                "error_type": type(error).__name__,
+                "traceback": "".join(traceback.format_exception(type(error), error, error.__traceback__)),
+                "count": 0,
+                "first_seen": now,
+            }
+        entry["count"] += 1
+        entry["last_seen"] = now
+        entry["message"] = message
+        entry["command"] = command
+        return fingerprint
+
+    async def flush_errors(self):
+        """
+        Upserts one row per queued fingerprint.
+        """
+        if not self.error_queue:
+            return 0
+        queue, self.error_queue = self.error_queue, {}
+        try:
+            await self.bot.pool.executemany("""INSERT INTO errors (fingerprint, error_type, traceback, message, command, count, first_seen, last_seen)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+            ON CONFLICT (fingerprint) DO UPDATE SET count = errors.count + excluded.count, last_seen = excluded.last_seen,
+            traceback = excluded.traceback, message = excluded.message, command = excluded.command""",
+                                            [(fingerprint, e["error_type"], e["traceback"], e["message"], e["command"],
+                                              e["count"], e["first_seen"], e["last_seen"]) for fingerprint, e in queue.items()])
+        except BaseException:
+            # put the batch back, merging it with anything queued in the meantime
+            for fingerprint, entry in queue.items():
+                newer = self.error_queue.setdefault(fingerprint, entry)
+                if newer is not entry:
+                    newer["count"] += entry["count"]
+                    newer["first_seen"] = entry["first_seen"]
+            raise
+        return len(queue)
 
     # todos
 
-    async def load_todos(self):
-        data = await self.bot.pool.fetch("SELECT * FROM todos")
-        for entry in data:
-            self.todos[entry["user_id"]] = entry["tasks"]
-
-    async def dump_todos(self):
-        items = deepcopy(self.todos).items()
-        for user_id, tasks_ in items:
-            await self.bot.pool.execute("UPDATE todos SET tasks = $1 WHERE user_id = $2", tasks_, user_id)
+    async def load_todo(self, user_id):
+        rows = await self.bot.pool.fetch(
+            "SELECT position, task, created_at FROM todo_items WHERE user_id = $1 ORDER BY position", user_id)
+        todo = utils.TodoList(rows) if rows else EMPTY_TODO
+        self.todos[user_id] = todo
+        return todo
 
-    async def create_todo(self, user_id):
-        await self.bot.pool.execute("INSERT INTO todos VALUES ($1)", user_id)
-        self.todos[user_id] = deepcopy(EMPTY_TODO)
-        return self.todos[user_id]
+    def on_todo_evict(self, user_id, todo):
+        # unflushed changes have to survive until the next flush, or until a flush in progress commits
+        if user_id in self.dirty["todos"] or (self.flushing is not None and user_id in self.flushing["todos"]):
+            self.unflushed_todos[user_id] = todo
 
-    async def delete_todo(self, user_id):
-        await self.bot.pool.execute("DELETE FROM todos WHERE user_id = $1", user_id)
-        self.todos.pop(user_id)
+    def mark_todo(self, user_id, position):
+        self.dirty["todos"].setdefault(user_id, set()).add(position)
 
     async def get_todo(self, user_id):
+        """
+        Returns a user's todo list, loading it on first access. Users without any tasks share a read-only empty list.
+        """
         todo = self.todos.get(user_id, None)
-        if todo is None:
-            return await self.create_todo(user_id)
-        return todo
-
-    async def cleanup_todo(self, user_id):
-        todo = await self.get_todo(user_id)
-        if todo == EMPTY_TODO:
-            await self.delete_todo(user_id)
+        if todo is not None:
+            return todo
+        if user_id in self.unflushed_todos:
+            todo = self.todos[user_id] = self.unflushed_todos.pop(user_id)
+            return todo
+
+        # concurrent misses for the same user share one query
+        task = self.todo_loads.get(user_id, None)
+        if task is None:
+            task = self.todo_loads[user_id] = self.bot.loop.create_task(self.load_todo(user_id))
+            task.add_done_callback(lambda _: self.todo_loads.pop(user_id, None))
+        return await asyncio.shield(task)
 
     async def add_todo(self, user_id, task):
-        await self.bot.pool.execute("UPDATE todos SET tasks = array_append(tasks, $1) WHERE user_id = $2", task, user_id)
-        (await self.get_todo(user_id)).append(task)
+        todo = await self.get_todo(user_id)
+        if todo is EMPTY_TODO:
+            todo = self.todos[user_id] = utils.TodoList()
+        self.mark_todo(user_id, todo.add(task))
 
     async def remove_todo(self, user_id, task):
-        await self.bot.pool.execute("UPDATE todos SET tasks = array_remove(tasks, $1) WHERE user_id = $2", task, user_id)
-        (await self.get_todo(user_id)).remove(task)
-
-        await self.cleanup_todo(user_id)
+        """
+        Removes a task by name.
+        """
+        self.mark_todo(user_id, (await self.get_todo(user_id)).remove(task))
+
+    async def remove_todo_at(self, user_id, number):
+        """
+        Removes a task by its number in the list and returns the task.
+        """
+        position, task = (await self.get_todo(user_id)).pop(number)
+        self.mark_todo(user_id, position)
+        return task
 
     async def clear_todos(self, user_id):
-        await self.bot.pool.execute("UPDATE todos SET tasks = '{}' WHERE user_id = $1", user_id)
-        (await self.get_todo(user_id)).clear()
-
-        await self.cleanup_todo(user_id)
+        todo = await self.get_todo(user_id)
+        for position in todo.positions if todo else ():
+            self.mark_todo(user_id, position)
+        self.todos[user_id] = EMPTY_TODO
+
+    # flushing
+
+    async def flush_table(self, connection, table: str, keys: set, key: str, column: str, lookup):
+        """
+        Writes the dirty rows of a table in one batch. Rows whose value is now empty are deleted.
+        """
+        values = {k: lookup(k) for k in keys}
+        upserts = [(k, list(v)) for k, v in values.items() if v]
+        deletes = [k for k, v in values.items() if not v]
+        if upserts:
+            await connection.executemany(
+                f"INSERT INTO {table} ({key}, {column}) VALUES ($1, $2) "
+                f"ON CONFLICT ({key}) DO UPDATE SET {column} = EXCLUDED.{column}", upserts)
+        if deletes:
+            await connection.execute(f"DELETE FROM {table} WHERE {key} = ANY($1::bigint[])", deletes)
+        return len(keys)
+
+    async def flush_todos(self, connection, dirty: dict):
+        """
+        Writes the todo items that were added or removed since the last flush.
+        """
+        user_ids, positions, inserts = [], [], []
+        for user_id, dirty_positions in dirty.items():
+            todo = self.todos.peek(user_id) or self.unflushed_todos.get(user_id)
+            for position in dirty_positions:
+                user_ids.append(user_id)
+                positions.append(position)
+                if todo and (item := todo.get_item(position)):
+                    inserts.append((user_id, position, *item))
+        # positions can be reused, so everything dirty is deleted before the current items are written
+        if user_ids:
+            await connection.execute("""DELETE FROM todo_items WHERE (user_id, position) IN
+            (SELECT * FROM unnest($1::bigint[], $2::bigint[]))""", user_ids, positions)
+        if inserts:
+            await connection.executemany("""INSERT INTO todo_items (user_id, position, task, created_at)
+            VALUES ($1, $2, $3, $4)""", inserts)
+        return len(positions)
+
+    async def flush(self):
+        """
+        Writes everything that changed since the last flush in one transaction.
+        If any of it fails, everything is marked dirty again for the next flush.
+        """
+        flushing = self.flushing = self.dirty
+        self.dirty = {"guild_info": set(), "todos": {}}
+        try:
+            with utils.StopWatch() as sw:
+                async with self.bot.pool.acquire() as connection:
+                    async with connection.transaction():
+                        rows = await self.flush_table(
+                            connection, "guild_info", flushing["guild_info"], "guild_id", "prefixes",
+                            lambda guild_id: self.guild_cache.get(guild_id, DEFAULT_GUILD_INFO)["prefixes"])
+                        rows += await self.flush_todos(connection, flushing["todos"])
+        except BaseException:  # includes cancellation from a flush timeout, the rollback undid every table
+            self.dirty["guild_info"] |= flushing["guild_info"]
+            for user_id, positions in flushing["todos"].items():
+                self.dirty["todos"].setdefault(user_id, set()).update(positions)
+            raise
+        finally:
+            self.flushing = None
+        self.unflushed_todos = {k: v for k, v in self.unflushed_todos.items() if k in self.dirty["todos"]}
+        self.last_flush = {"rows": rows, "elapsed": sw.elapsed, "time": datetime.datetime.now()}
+        if rows:
+            log.info("Flushed %s row(s) in %.3fs", rows, sw.elapsed)
+        return rows
 
 
 class CustomContext(commands.Context):
     """
     Custom context class.
     """
+    invoked_at = None
+
     @property
     def clean_prefix(self):
         prefix = re.sub(f"<@!?{self.bot.user.id}>", "@PB Bot", self.prefix)
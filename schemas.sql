@@ -1,8 +1,25 @@
-CREATE TABLE IF NOT EXISTS todos (
-    user_id bigint PRIMARY KEY,
-    tasks text[] DEFAULT '{}'
+CREATE TABLE IF NOT EXISTS todo_items (
+    user_id    bigint,
+    position   bigint,
+    task       text,
+    created_at timestamp DEFAULT (now() AT TIME ZONE 'utc'),
+    PRIMARY KEY (user_id, position)
 );
 
+CREATE UNIQUE INDEX IF NOT EXISTS todo_items_user_id_task_idx ON todo_items (user_id, task);
+
+-- one-shot migration from the old text[] column
+DO $$
+BEGIN
+    IF to_regclass('todos') IS NOT NULL THEN
+        INSERT INTO todo_items (user_id, position, task)
+        SELECT user_id, item.position, item.task FROM todos, unnest(tasks) WITH ORDINALITY AS item(task, position)
+        ON CONFLICT DO NOTHING;
+        DROP TABLE todos;
+    END IF;
+END
+$$;
+
 CREATE TABLE IF NOT EXISTS errors (
     err_num    SERIAL,
     traceback  text,
@@ -10,13 +27,80 @@ CREATE TABLE IF NOT EXISTS errors (
     command    text
     );
 
+ALTER TABLE errors
+    ADD COLUMN IF NOT EXISTS fingerprint text,
+    ADD COLUMN IF NOT EXISTS error_type  text,
+    ADD COLUMN IF NOT EXISTS count       bigint DEFAULT 1,
+    ADD COLUMN IF NOT EXISTS first_seen  timestamp DEFAULT (now() AT TIME ZONE 'utc'),
+    ADD COLUMN IF NOT EXISTS last_seen   timestamp DEFAULT (now() AT TIME ZONE 'utc');
+
+-- one-shot migration of rows from before fingerprinting, identical tracebacks are merged
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM errors WHERE fingerprint IS NULL) THEN
+        UPDATE errors SET fingerprint = md5(coalesce(traceback, '')) WHERE fingerprint IS NULL;
+        UPDATE errors SET count = dupes.count
+        FROM (SELECT min(err_num) AS err_num, SUM(count) AS count FROM errors GROUP BY fingerprint HAVING COUNT(*) > 1) dupes
+        WHERE errors.err_num = dupes.err_num;
+        DELETE FROM errors a USING errors b WHERE a.fingerprint = b.fingerprint AND a.err_num > b.err_num;
+    END IF;
+END
+$$;
+
+CREATE UNIQUE INDEX IF NOT EXISTS errors_fingerprint_idx ON errors (fingerprint);
+CREATE INDEX IF NOT EXISTS errors_count_idx ON errors (count DESC, err_num);
+CREATE UNIQUE INDEX IF NOT EXISTS errors_err_num_idx ON errors (err_num);
+
 CREATE TABLE IF NOT EXISTS guild_info (
     guild_id bigint PRIMARY KEY,
     prefixes text[] DEFAULT '{}'
     );
 
-CREATE TABLE IF NOT EXISTS command_stats (
-    date date,
-    commands text,
-    users text
-)
+CREATE TABLE IF NOT EXISTS daily_command_stats (
+    date    date,
+    command text,
+    uses    bigint,
+    PRIMARY KEY (date, command)
+);
+
+CREATE INDEX IF NOT EXISTS daily_command_stats_command_date_idx ON daily_command_stats (command, date);
+
+CREATE TABLE IF NOT EXISTS daily_user_stats (
+    date    date,
+    user_id bigint,
+    uses    bigint,
+    PRIMARY KEY (date, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS daily_user_stats_user_id_date_idx ON daily_user_stats (user_id, date);
+
+-- one-shot migration from the old json blobs
+DO $$
+BEGIN
+    IF to_regclass('command_stats') IS NOT NULL THEN
+        INSERT INTO daily_command_stats (date, command, uses)
+        SELECT date, item.key, SUM(item.value::bigint) FROM command_stats, json_each_text(commands::json) AS item
+        GROUP BY date, item.key
+        ON CONFLICT DO NOTHING;
+        INSERT INTO daily_user_stats (date, user_id, uses)
+        SELECT date, item.key::bigint, SUM(item.value::bigint) FROM command_stats, json_each_text(users::json) AS item
+        GROUP BY date, item.key
+        ON CONFLICT DO NOTHING;
+        DROP TABLE command_stats;
+    END IF;
+END
+$$;
+
+CREATE TABLE IF NOT EXISTS xkcd_comics (
+    num   int PRIMARY KEY,
+    title text,
+    alt   text,
+    img   text,
+    date  date
+);
+
+CREATE TABLE IF NOT EXISTS definitions (
+    word       text PRIMARY KEY,
+    data       bytea,  -- zlib compressed json, NULL for unknown words
+    fetched_at timestamp DEFAULT (now() AT TIME ZONE 'utc')
+);
@@ -0,0 +1,38 @@
+"""
+Compares the old per-message prefix loop with the compiled matcher get_prefix uses now.
+Run with `python -m tests.bench_prefixes` from the repo root.
+"""
+import re
+import timeit
+
+import utils
+
+ITERATIONS = 20_000
+
+
+def old_get_prefix(prefixes, content):
+    for prefix in sorted(prefixes, key=len):
+        match = re.match(f"^({prefix}\\s*).*", content, flags=re.IGNORECASE)
+        if match:
+            return match.group(1)
+
+
+def new_get_prefix(matcher, content):
+    match = matcher.match(content)
+    if match:
+        return match.group(0)
+
+
+def main():
+    for size in (1, 10, 50):
+        prefixes = [f"p{i}x" for i in range(size)]
+        content = f"{prefixes[-1]} help"  # the last prefix tried is the worst case for the old loop
+        matcher = utils.compile_prefixes(prefixes)
+        assert old_get_prefix(prefixes, content) == new_get_prefix(matcher, content)
+        old = min(timeit.repeat(lambda: old_get_prefix(prefixes, content), number=ITERATIONS, repeat=5))
+        new = min(timeit.repeat(lambda: new_get_prefix(matcher, content), number=ITERATIONS, repeat=5))
+        print(f"{size:>3} prefix(es): {old / ITERATIONS * 1e6:8.2f}us -> {new / ITERATIONS * 1e6:.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+from aiohttp import web
+
+
+class StandInServer:
+    """
+    A local server for tests. Routes are `(method, path, handler)` tuples and every request is counted by path.
+    """
+    def __init__(self, routes):
+        self.app = web.Application()
+        self.hits = {}
+        for method, path, handler in routes:
+            self.app.router.add_route(method, path, self.counted(path, handler))
+        self.runner = web.AppRunner(self.app, access_log=None)
+        self.url = None
+
+    def counted(self, path, handler):
+        async def wrapper(request):
+            self.hits[path] = self.hits.get(path, 0) + 1
+            return await handler(request)
+        return wrapper
+
+    async def start(self):
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def close(self):
+        await self.runner.cleanup()
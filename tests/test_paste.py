@@ -0,0 +1,59 @@
+import unittest
+
+import aiohttp
+from aiohttp import web
+
+import utils
+from tests.server import StandInServer
+
+
+async def documents(request):
+    await request.read()
+    return web.json_response({"key": "abcdef"})
+
+
+async def unavailable(request):
+    return web.Response(status=503)
+
+
+class PasteClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = StandInServer([("POST", "/up/documents", documents), ("POST", "/down/documents", unavailable)])
+        await self.server.start()
+        self.session = aiohttp.ClientSession()
+        self.http = utils.HTTPClient(self.session, retries=0)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.server.close()
+
+    def client(self, *names):
+        return utils.PasteClient(self.http, [utils.PasteBackend(name, f"{self.server.url}/{name}") for name in names])
+
+    async def test_fails_over_to_the_next_backend(self):
+        url = await self.client("down", "up").paste("hello", prefer="down")
+        self.assertEqual(url, f"{self.server.url}/up/abcdef")
+        self.assertEqual(self.server.hits, {"/down/documents": 1, "/up/documents": 1})
+
+    async def test_fails_over_without_retrying_with_the_default_client(self):
+        client = utils.PasteClient(utils.HTTPClient(self.session), [
+            utils.PasteBackend(name, f"{self.server.url}/{name}") for name in ("down", "up")])
+        url = await client.paste("hello", prefer="down")
+        self.assertEqual(url, f"{self.server.url}/up/abcdef")
+        self.assertEqual(self.server.hits, {"/down/documents": 1, "/up/documents": 1})
+
+    async def test_repeated_paste_is_served_from_the_cache(self):
+        client = self.client("up")
+        first = await client.paste("hello")
+        second = await client.paste("hello")
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.hits, {"/up/documents": 1})
+
+    async def test_raises_when_every_backend_fails(self):
+        with self.assertRaises(utils.PasteError):
+            await self.client("down").paste("hello")
+        self.assertEqual(self.server.hits, {"/down/documents": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
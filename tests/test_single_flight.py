@@ -0,0 +1,74 @@
+import asyncio
+import unittest
+
+import aiohttp
+from aiohttp import web
+
+import utils
+from tests.server import StandInServer
+
+CALLERS = 50
+
+
+async def slow(request):
+    await asyncio.sleep(0.05)  # long enough for every caller to pile up behind the first request
+    return web.json_response({"ok": True})
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def test_callers_share_the_result(self):
+        flight = utils.SingleFlight()
+        calls = 0
+
+        async def func():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+
+        results = await asyncio.gather(*(flight.do("key", func) for _ in range(CALLERS)))
+        self.assertEqual(results, [1] * CALLERS)
+        self.assertEqual(flight.coalesced, CALLERS - 1)
+        self.assertNotIn("key", flight)
+
+    async def test_callers_share_the_error(self):
+        flight = utils.SingleFlight()
+
+        async def func():
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream")
+
+        results = await asyncio.gather(*(flight.do("key", func) for _ in range(CALLERS)), return_exceptions=True)
+        self.assertEqual(len(results), CALLERS)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(flight.coalesced, CALLERS - 1)
+        self.assertNotIn("key", flight)
+
+
+class HTTPClientCoalescingTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = StandInServer([("GET", "/slow", slow)])
+        await self.server.start()
+        self.session = aiohttp.ClientSession()
+        self.http = utils.HTTPClient(self.session, cache=utils.ResponseCache(), retries=0)
+        self.url = f"{self.server.url}/slow"
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.server.close()
+
+    async def test_concurrent_gets_make_one_request(self):
+        responses = await asyncio.gather(*(self.http.get(self.url) for _ in range(CALLERS)))
+        self.assertEqual(self.server.hits, {"/slow": 1})
+        self.assertTrue(all(response.json() == {"ok": True} for response in responses))
+        self.assertEqual(self.http.inflight.coalesced, CALLERS - 1)
+
+    async def test_concurrent_cached_gets_make_one_request(self):
+        await asyncio.gather(*(self.http.get(self.url, ttl=60) for _ in range(CALLERS)))
+        await self.http.get(self.url, ttl=60)
+        self.assertEqual(self.server.hits, {"/slow": 1})
+        self.assertEqual(self.http.inflight.coalesced, CALLERS - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
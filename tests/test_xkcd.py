@@ -0,0 +1,53 @@
+import datetime
+import unittest
+
+import utils
+
+COMICS = [
+    (1, "Barrel - Part 1", "Don't we all."),
+    (2, "Petit Trees (sketch)", "'Petit' being a reference to Le Petit Prince, which I only thought about halfway through the sketch"),
+    (3, "Island (sketch)", "Hello, island"),
+    (4, "Landscape (sketch)", "There's a river flowing through the ocean"),
+    (5, "Blown apart", "Blown into prime factors"),
+    (6, "Irony", "Hey, I made a joke about irony."),
+    (7, "Girl sleeping (Sketch -- 11th grade Spanish class)", "I'm not sure what the girl in the drawing was dreaming of."),
+    (8, "Red spiders", "Red spiders are the best kind of spiders."),
+]
+
+
+class XkcdIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = utils.XkcdIndex()
+        for num, title, alt in COMICS:
+            self.add(self.index, num, title, alt)
+
+    def add(self, index, num, title, alt):
+        index.add({"num": num, "title": title, "alt": alt, "img": "", "date": datetime.date(2006, 1, 1)})
+
+    def search(self, query):
+        comic = self.index.search(query)
+        return comic and comic["num"]
+
+    def test_exact_title(self):
+        self.assertEqual(self.search("red spiders"), 8)
+
+    def test_rare_words_outweigh_common_ones(self):
+        # "the" and "sketch" match more comics than "river", which only #4 has
+        self.assertEqual(self.search("the sketch of the river"), 4)
+
+    def test_title_words_outweigh_alt_words(self):
+        self.assertEqual(self.search("island thought"), 3)
+
+    def test_words_every_comic_has_match_nothing(self):
+        index = utils.XkcdIndex()
+        for num, title in enumerate(("The cat", "A dog", "Fish"), 1):
+            self.add(index, num, title, "the end")
+        self.assertIsNone(index.search("the"))
+        self.assertEqual(index.search("the dog")["num"], 2)
+
+    def test_no_match(self):
+        self.assertIsNone(self.search("velociraptor"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,10 +5,28 @@ from discord.ext import commands
 import datetime
 import time
 import random
-from collections import deque
+from collections import deque, OrderedDict, Counter, defaultdict
 import asyncio
+import aiohttp
+import bisect
+import array
+import heapq
+import math
+import sys
+import zlib
+import json
+import email.utils
+from urllib.parse import urlsplit, urlencode, quote
+import codecs
+import hashlib
+import os
+import threading
+import traceback
 import dateparser
 import humanize
+import logging
+
+log = logging.getLogger(__name__)
 
 
 # helper functions
@@ -41,6 +59,102 @@ def humanize_list(li: list):
     return f"{', '.join(str(item) for item in li[:-1])} and {li[-1]}"
 
 
+def latency_table(histograms: dict):
+    """
+    Formats command latency histograms as lines of p50/p95/p99/max in milliseconds, busiest commands first.
+    """
+    rows = sorted(histograms.items(), key=lambda item: item[1].count, reverse=True)
+    width = max((len(name) for name, _ in rows), default=0)
+    lines = [f"{'command'.ljust(width)} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"]
+    for name, histogram in rows:
+        values = " ".join(f"{value * 1000:>8.1f}" for value in histogram.summary())
+        lines.append(f"{name.ljust(width)} {values}")
+    return lines
+
+
+def error_fingerprint(error: BaseException):
+    """
+    Hashes the exception type with the file and function of every frame in its traceback.
+    Line numbers and the message are left out so the same error keeps its fingerprint across edits and inputs.
+    """
+    frames = []
+    for frame in traceback.extract_tb(error.__traceback__):
+        filename = frame.filename.rpartition(f"site-packages{os.sep}")[2]
+        frames.append(f"{os.path.relpath(filename) if os.path.isabs(filename) else filename}:{frame.name}")
+    error_type = type(error)
+    key = "\n".join([f"{error_type.__module__}.{error_type.__qualname__}", *frames])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "png",
+    b"\xff\xd8\xff": "jpeg",
+    b"GIF87a": "gif",
+    b"GIF89a": "gif",
+    b"BM": "bmp",
+}
+SNIFF_SIZE = 512
+
+
+def sniff(head: bytes, kind: str):
+    """
+    Checks the first bytes of a file against the expected kind, `image` or `text`.
+    """
+    if kind == "image":
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return True
+        return any(head.startswith(signature) for signature in IMAGE_SIGNATURES)
+    if b"\x00" in head:
+        return False
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head)  # the head may end halfway through a character
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+async def fetch_attachment(session: aiohttp.ClientSession, source, *, max_size: int, kind: str):
+    """
+    Downloads an attachment or asset, giving up as soon as it is larger than `max_size` bytes or isn't of the expected kind.
+    The declared size and Content-Length are checked before anything is downloaded, then the body is streamed in chunks.
+    """
+    too_large = AttachmentError(f"File is too large (>{humanize.naturalsize(max_size)}).")
+    wrong_kind = AttachmentError("Only text files can be used." if kind == "text" else
+                                 "Only PNG, JPEG, GIF, WEBP and BMP images can be used.")
+    if isinstance(source, discord.Attachment):
+        if source.size > max_size:
+            raise too_large
+        url = source.url
+    else:
+        url = str(source)
+
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as r:
+        r.raise_for_status()
+        if r.content_length is not None and r.content_length > max_size:
+            raise too_large
+        data = bytearray()
+        sniffed = False
+        async for chunk in r.content.iter_chunked(64 * 1024):
+            data += chunk
+            if len(data) > max_size:
+                raise too_large
+            if not sniffed and len(data) >= SNIFF_SIZE:
+                if not sniff(bytes(data[:SNIFF_SIZE]), kind):
+                    raise wrong_kind
+                sniffed = True
+    if not sniffed and not sniff(bytes(data), kind):
+        raise wrong_kind
+    return bytes(data)
+
+
+def compile_prefixes(prefixes: list):
+    """
+    Compiles a list of prefixes into a single case-insensitive pattern. Longer prefixes are tried first.
+    """
+    alternation = "|".join(re.escape(prefix) for prefix in sorted(prefixes, key=len, reverse=True))
+    return re.compile(f"(?:{alternation})\\s*", flags=re.IGNORECASE)
+
+
 class StopWatch:
     __slots__ = ("start_time", "end_time")
 
@@ -66,6 +180,1015 @@ class StopWatch:
         return self.end_time - self.start_time
 
 
+class LRUCache:
+    """
+    Mapping that evicts the least recently used entry once it holds more than `maxsize` entries.
+    """
+    __slots__ = ("maxsize", "on_evict", "hits", "misses", "evictions", "_data")
+
+    def __init__(self, maxsize: int, *, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            evicted_key, evicted_value = self._data.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(evicted_key, evicted_value)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        """
+        Like `get` but doesn't count towards the stats or touch the entry's recency.
+        """
+        return self._data.get(key, default)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def items(self):
+        return list(self._data.items())
+
+    def clear(self):
+        self._data.clear()
+
+
+class SpaceSaving:
+    """
+    Approximate top-k counter with fixed memory (the Space-Saving algorithm).
+    A tracked count overestimates the real count by at most `error_bound`.
+    """
+    __slots__ = ("capacity", "total", "counts", "errors", "_heap")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        self._heap = []  # one (count, key) entry per key, counts may be stale
+
+    @classmethod
+    def from_error(cls, epsilon: float):
+        """
+        Creates a counter whose counts are off by at most `epsilon` times the total count.
+        """
+        return cls(math.ceil(1 / epsilon))
+
+    @property
+    def error_bound(self):
+        return self.total / self.capacity
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _pop_min(self):
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self.counts[key] != count:  # stale entry
+                heapq.heappush(self._heap, (self.counts[key], key))
+                continue
+            del self.counts[key]
+            del self.errors[key]
+            return count
+
+    def add(self, key, count: int = 1):
+        self.total += count
+        if key in self.counts:
+            self.counts[key] += count
+            return
+        error = self._pop_min() if len(self.counts) >= self.capacity else 0
+        self.counts[key] = error + count
+        self.errors[key] = error
+        heapq.heappush(self._heap, (error + count, key))
+
+    def update(self, mapping: dict):
+        """
+        Same as `collections.Counter.update`.
+        """
+        for key, count in mapping.items():
+            self.add(key, count)
+
+    def most_common(self, n: int = None):
+        if n is None:
+            return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        return heapq.nlargest(n, self.counts.items(), key=lambda item: item[1])
+
+    def clear(self):
+        self.total = 0
+        self.counts.clear()
+        self.errors.clear()
+        self._heap.clear()
+
+    def _rebuild(self, entries: dict):
+        top = heapq.nlargest(self.capacity, entries.items(), key=lambda item: item[1][0])
+        self.counts = {key: count for key, (count, _) in top}
+        self.errors = {key: error for key, (_, error) in top}
+        self._heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    @classmethod
+    def deserialize(cls, capacity: int, data: dict, *, errors: dict = None, total: int = None):
+        """
+        Builds a counter from `{key: count}` with the errors given separately, or from the older `{key: "count:error"}` form.
+        The total defaults to the sum of the counts.
+        """
+        errors = errors or {}
+        counter = cls(capacity)
+        entries = {}
+        for key, value in data.items():
+            count, _, error = str(value).partition(":")
+            entries[key] = (int(float(count)), int(error or errors.get(key, 0)))
+        counter.total = total if total is not None else sum(count for count, _ in entries.values())
+        counter._rebuild(entries)
+        return counter
+
+
+class LatencyHistogram:
+    """
+    Log-linear (HDR-style) histogram of durations. Each power of two is split into linear sub-buckets,
+    so a recorded value is off by at most 1 / 2 ** (SUB_BUCKET_BITS - 1).
+    """
+    SUB_BUCKET_BITS = 5
+    MAX_BITS = 40  # about 12 days in microseconds
+    __slots__ = ("buckets", "count", "max")
+
+    _half = 1 << (SUB_BUCKET_BITS - 1)
+    _size = _half * (MAX_BITS - SUB_BUCKET_BITS) + (1 << SUB_BUCKET_BITS)
+
+    def __init__(self):
+        self.buckets = array.array("Q", bytes(8 * self._size))
+        self.count = 0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, us: int):
+        shift = us.bit_length() - cls.SUB_BUCKET_BITS
+        if shift <= 0:
+            return us
+        return min(cls._half * shift + (us >> shift), cls._size - 1)
+
+    @classmethod
+    def _upper_bound(cls, index: int):
+        if index < 2 * cls._half:
+            return index + 1
+        shift = index // cls._half - 1
+        return (index - cls._half * shift + 1) << shift
+
+    def record(self, seconds: float):
+        us = int(seconds * 1_000_000)
+        self.buckets[self._index(us)] += 1
+        self.count += 1
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, percent: float):
+        """
+        Returns the given percentile in seconds.
+        """
+        if not self.count:
+            return 0
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return min(self._upper_bound(index), self.max) / 1_000_000
+        return self.max / 1_000_000
+
+    def summary(self):
+        """
+        Returns the p50, p95, p99 and max in seconds.
+        """
+        return self.percentile(50), self.percentile(95), self.percentile(99), self.max / 1_000_000
+
+
+class StallDetector:
+    """
+    Watches the event loop from another thread. When the loop doesn't get to run for `threshold` seconds,
+    the stack of the loop's thread is recorded. Stacks are grouped by their frames.
+    """
+    def __init__(self, loop, *, interval: float = 0.1, threshold: float = 0.25, max_stacks: int = 100, max_frames: int = 15):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.max_stacks = max_stacks
+        self.max_frames = max_frames
+
+        self.lag = 0.0  # lag of the last heartbeat
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self.stalls = Counter()  # signature: times seen
+        self.stacks = {}  # signature: formatted stack
+
+        self._last_beat = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.lag = max(now - expected, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+            self._last_beat = now
+
+    def _watch(self):
+        captured_beat = None
+        while not self._stop.wait(self.interval):
+            beat = self._last_beat
+            if time.monotonic() - beat < self.threshold or beat == captured_beat:  # one capture per stall
+                continue
+            captured_beat = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)[-self.max_frames:]
+            del frame
+            signature = tuple((f.filename, f.lineno, f.name) for f in stack)
+            with self._lock:
+                self.stall_count += 1
+                if signature not in self.stacks:
+                    if len(self.stacks) >= self.max_stacks:
+                        continue
+                    self.stacks[signature] = "".join(traceback.format_list(stack))
+                self.stalls[signature] += 1
+
+    def start(self):
+        """
+        Starts watching. Must be called from the loop's thread.
+        """
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()  # startup work since __init__ isn't a stall
+        self._task = self.loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="stall-detector", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    def most_common(self, n: int = None):
+        """
+        Returns (formatted stack, times seen) pairs, most seen first.
+        """
+        with self._lock:
+            return [(self.stacks[signature], count) for signature, count in self.stalls.most_common(n)]
+
+    def clear(self):
+        with self._lock:
+            self.stalls.clear()
+            self.stacks.clear()
+            self.max_lag = 0.0
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread from a separate thread and aggregates them in the collapsed stack format
+    used by flamegraph tools. The sampling interval grows when sampling gets expensive, keeping the overhead at about `max_overhead`.
+    """
+    def __init__(self, *, interval: float = 0.01, max_overhead: float = 0.1):
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.samples = Counter()
+        self.sample_count = 0
+
+    def _sample(self, duration: float):
+        own_id = threading.get_ident()
+        end = time.monotonic() + duration
+        while (start := time.monotonic()) < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+            cost = time.monotonic() - start
+            time.sleep(max(self.interval, cost / self.max_overhead - cost))
+
+    async def run(self, duration: float):
+        """
+        Samples for `duration` seconds without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def target():
+            try:
+                self._sample(duration)
+            finally:
+                loop.call_soon_threadsafe(done.set_result, None)
+
+        threading.Thread(target=target, name="sampling-profiler", daemon=True).start()
+        await done
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+
+class MetricsWriter:
+    """
+    Builds a page in the prometheus text format.
+    """
+    __slots__ = ("lines",)
+
+    def __init__(self):
+        self.lines = []
+
+    @staticmethod
+    def _labels(labels: dict):
+        if not labels:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+        return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+    def add(self, name: str, type_: str, help_: str, samples):
+        """
+        Adds a metric. `samples` is either a single value or a list of (labels, value) pairs.
+        """
+        self.lines.append(f"# HELP {name} {help_}")
+        self.lines.append(f"# TYPE {name} {type_}")
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self.lines.append(f"{name}{self._labels(labels)} {value}")
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class AttachmentError(commands.CommandError):
+    pass
+
+
+class HTTPResponse:
+    """
+    A fully read response, so the connection goes back to the pool before the caller looks at it.
+    """
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, status: int, headers, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+    def text(self):
+        return self.body.decode("utf-8", errors="replace")
+
+
+class SingleFlight:
+    """
+    Lets concurrent calls with the same key share one in-flight call and its result or error.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    def __contains__(self, key):
+        return key in self.calls
+
+    def done(self, key, future):
+        del self.calls[key]
+        if not future.cancelled():
+            future.exception()  # retrieved, in case every caller was cancelled
+
+    async def do(self, key, func, *args, **kwargs):
+        future = self.calls.get(key)
+        if future is None:
+            future = self.calls[key] = asyncio.ensure_future(func(*args, **kwargs))
+            future.add_done_callback(lambda future: self.done(key, future))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)  # a caller giving up doesn't cancel the call for the others
+
+
+class ResponseCache:
+    """
+    Caches responses in an LRU and optionally in redis, where they are shared between processes and survive restarts.
+    Entries are (response, expires_at) and are kept for their stale period after expiring.
+    """
+    def __init__(self, maxsize: int = 2048, *, redis=None):
+        self.entries = LRUCache(maxsize)
+        self.redis = redis
+
+    async def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None and self.redis is not None:
+            data = await self.redis.get(f"http:{key}")
+            if data is not None:
+                expires_at, status, body = data.split(b"\n", 2)
+                entry = self.entries[key] = (HTTPResponse(int(status), {}, body), float(expires_at))
+        return entry
+
+    async def set(self, key: str, response: HTTPResponse, ttl: float, stale_ttl: float):
+        expires_at = time.time() + ttl
+        self.entries[key] = (response, expires_at)
+        if self.redis is not None:
+            data = b"%f\n%d\n" % (expires_at, response.status) + response.body
+            await self.redis.set(f"http:{key}", data, expire=math.ceil(ttl + stale_ttl))
+
+
+class HTTPClient:
+    """
+    Makes requests to external APIs through the bot's session.
+    Requests are limited per host, retried with jittered backoff on connection errors, 429s and 5xxs (honoring
+    Retry-After) and timed per host for the metrics.
+    GETs with a `ttl` go through the response cache.
+    """
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, session: aiohttp.ClientSession, *, cache: ResponseCache = None, host_limits: dict = None,
+                 default_limit: int = 8, retries: int = 3, backoff: float = 0.5, max_backoff: float = 30):
+        self.session = session
+        self.cache = cache
+        self.inflight = SingleFlight()
+        self.host_limits = host_limits or {}
+        self.default_limit = default_limit
+        self.semaphores = {}
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = defaultdict(lambda: {"latency": LatencyHistogram(), "responses": Counter(), "errors": Counter(),
+                                          "retries": 0, "cache": Counter()})
+
+    def get_semaphore(self, host: str):
+        semaphore = self.semaphores.get(host)
+        if semaphore is None:
+            semaphore = self.semaphores[host] = asyncio.Semaphore(self.host_limits.get(host, self.default_limit))
+        return semaphore
+
+    def retry_delay(self, attempt: int, response: HTTPResponse = None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:  # an HTTP date
+                try:
+                    delay = (email.utils.parsedate_to_datetime(retry_after)
+                             - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    delay = self.backoff
+            return min(max(delay, 0), self.max_backoff)
+        return random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))  # full jitter
+
+    async def request(self, method: str, url: str, *, retries: int = None, **kwargs):
+        """
+        Makes a request and reads the whole body. Responses with a retryable status are returned after the last retry.
+        `retries` overrides the client's default, e.g. for requests that aren't safe to repeat.
+        """
+        host = urlsplit(url).hostname
+        stats = self.stats[host]
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            last = attempt == retries
+            try:
+                async with self.get_semaphore(host):
+                    with StopWatch() as sw:
+                        async with self.session.request(method, url, **kwargs) as r:
+                            response = HTTPResponse(r.status, r.headers, await r.read())
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                stats["errors"][type(e).__name__] += 1
+                if last:
+                    raise
+                delay = self.retry_delay(attempt)
+            else:
+                stats["latency"].record(sw.elapsed)
+                stats["responses"][response.status] += 1
+                if last or response.status not in self.RETRY_STATUSES:
+                    return response
+                delay = self.retry_delay(attempt, response)
+            stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+    async def get(self, url: str, *, params: dict = None, ttl: float = None, stale_ttl: float = 0,
+                  negative_ttl: float = 60, **kwargs):
+        """
+        Makes a GET request, sharing it with identical requests that are still in flight. With a `ttl`, successful
+        responses are cached for `ttl` seconds and then served for another `stale_ttl` seconds while they are refreshed
+        in the background. 404s are cached for `negative_ttl` seconds.
+        """
+        normalized = f"{url}?{urlencode(sorted(params.items()))}" if params else url
+        key = hashlib.sha1(normalized.encode()).hexdigest()
+        if ttl is None or self.cache is None:
+            return await self.inflight.do(("GET", key), self.request, "GET", url, params=params, **kwargs)
+        stats = self.stats[urlsplit(url).hostname]["cache"]
+        entry = await self.cache.get(key)
+        if entry is not None:
+            response, expires_at = entry
+            now = time.time()
+            if now < expires_at:
+                stats["hit"] += 1
+                return response
+            if now < expires_at + stale_ttl:
+                stats["stale"] += 1
+                if key not in self.inflight:
+                    task = asyncio.ensure_future(
+                        self.inflight.do(key, self.fetch, key, url, params, ttl, stale_ttl, negative_ttl, kwargs))
+                    task.add_done_callback(self.revalidated)
+                return response
+        stats["miss"] += 1
+        return await self.inflight.do(key, self.fetch, key, url, params, ttl, stale_ttl, negative_ttl, kwargs)
+
+    async def fetch(self, key, url, params, ttl, stale_ttl, negative_ttl, kwargs):
+        response = await self.request("GET", url, params=params, **kwargs)
+        if 200 <= response.status < 300:
+            await self.cache.set(key, response, ttl, stale_ttl)
+        elif response.status == 404:
+            await self.cache.set(key, response, min(ttl, negative_ttl), 0)
+        return response
+
+    @staticmethod
+    def revalidated(task):
+        if not task.cancelled() and task.exception() is not None:
+            log.warning("Failed to revalidate a cached response: %r", task.exception())
+
+
+class PasteError(Exception):
+    pass
+
+
+class PasteBackend:
+    """
+    A hastebin compatible paste service, the content is POSTed to `<url>/documents` which returns the key of the paste.
+    Subclass and override `upload` for services with a different API.
+    """
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url.rstrip("/")
+
+    async def upload(self, http: HTTPClient, data: str, *, timeout: float):
+        # no retries, a failing backend fails over to the next one straight away and a POST isn't replayed
+        r = await http.request("POST", f"{self.url}/documents", data=data.encode("utf-8"), retries=0,
+                               timeout=aiohttp.ClientTimeout(total=timeout))
+        if r.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=r.status)
+        return f"{self.url}/{r.json()['key']}"
+
+
+class PasteClient:
+    """
+    Uploads pastes, failing over to the next backend when one is down.
+    URLs are remembered by the hash of their content in an LRU, with redis as a second tier shared between restarts,
+    so the same content is only uploaded once per backend.
+    """
+    def __init__(self, http: HTTPClient, backends: list, *, redis=None, cache_size: int = 1024,
+                 ttl: int = 7 * 24 * 60 * 60, timeout: float = 10):
+        self.http = http
+        self.backends = {backend.name: backend for backend in backends}
+        self.redis = redis
+        self.urls = LRUCache(cache_size)  # {content hash: {backend name: url}}
+        self.ttl = ttl
+        self.timeout = timeout
+
+    async def get_urls(self, digest: str):
+        urls = self.urls.get(digest)
+        if urls is None:
+            urls = {}
+            if self.redis is not None:
+                urls = await self.redis.hgetall(f"paste:{digest}", encoding="utf-8")
+            self.urls[digest] = urls
+        return urls
+
+    async def paste(self, data: str, *, prefer: str = None):
+        """
+        Returns the URL of a paste of `data`, preferably on the `prefer` backend.
+        """
+        digest = hashlib.sha256(data.encode("utf-8")).hexdigest()
+        urls = await self.get_urls(digest)
+        order = sorted(self.backends.values(), key=lambda backend: backend.name != prefer)
+        for backend in order:
+            if backend.name in urls:
+                return urls[backend.name]
+        for backend in order:
+            try:
+                url = await backend.upload(self.http, data, timeout=self.timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+                log.warning("Paste backend %s failed: %r", backend.name, e)
+                continue
+            urls[backend.name] = url
+            if self.redis is not None:
+                key = f"paste:{digest}"
+                transaction = self.redis.multi_exec()
+                transaction.hset(key, backend.name, url)
+                transaction.expire(key, self.ttl)
+                await transaction.execute()
+            return url
+        raise PasteError("Every paste backend failed.")
+
+
+class SubredditNotFound(Exception):
+    pass
+
+
+class RedditBuffers:
+    """
+    Shuffled buffers of a subreddit's newest posts, kept for the most recently used subreddits.
+    Posts are drawn without replacement until the buffer runs out or gets too old, then it is refilled.
+    """
+    def __init__(self, http: HTTPClient, *, maxsize: int = 256, max_age: float = 10 * 60):
+        self.http = http
+        self.buffers = LRUCache(maxsize)  # {subreddit: {"posts": [...], "fetched_at": ..., "draws": ...}}
+        self.max_age = max_age
+        self.inflight = SingleFlight()
+
+    async def fill(self, subreddit: str):
+        r = await self.http.get(f"https://www.reddit.com/r/{subreddit}/new.json", params={"limit": "100"})
+        data = r.json()
+        if r.status == 404 or data.get("error", None) is not None:
+            raise SubredditNotFound(subreddit)
+        posts = [child["data"] for child in data["data"]["children"]]
+        random.shuffle(posts)
+        buffer = self.buffers[subreddit] = {"posts": posts, "fetched_at": time.monotonic(), "draws": 0}
+        return buffer
+
+    async def draw(self, subreddit: str):
+        """
+        Returns a random post that hasn't been drawn since the last refill, or None if the subreddit has no posts.
+        """
+        subreddit = subreddit.lower()
+        buffer = self.buffers.get(subreddit)
+        if buffer is None or not buffer["posts"] or time.monotonic() - buffer["fetched_at"] > self.max_age:
+            buffer = await self.inflight.do(subreddit, self.fill, subreddit)
+        buffer["draws"] += 1
+        return buffer["posts"].pop() if buffer["posts"] else None
+
+    async def refresh_hot(self, min_draws: int = 5):
+        """
+        Refills the buffers of subreddits with at least `min_draws` draws since their last fill.
+        """
+        hot = [subreddit for subreddit, buffer in self.buffers.items() if buffer["draws"] >= min_draws]
+        results = await asyncio.gather(*(self.inflight.do(subreddit, self.fill, subreddit) for subreddit in hot),
+                                       return_exceptions=True)
+        for subreddit, result in zip(hot, results):
+            if isinstance(result, SubredditNotFound):
+                self.buffers.pop(subreddit)
+        return len(hot)
+
+
+class DiscordStatus:
+    """
+    The latest discord status from https://discordstatus.com with its embeds prebuilt.
+    `poll` fetches it again and returns what changed since the last poll.
+    """
+    SUMMARY_URL = "https://srhpyqt94yxb.statuspage.io/api/v2/summary.json"
+    INCIDENTS_URL = "https://srhpyqt94yxb.statuspage.io/api/v2/incidents.json"
+
+    def __init__(self, colour: int):
+        self.colour = colour
+        self.snapshot = None
+        self.embeds = []
+        self.history_embeds = []
+        self.updated_at = None
+        self.created_dates = {}  # {created_at: parsed}, so each incident's date is only parsed once
+
+    @staticmethod
+    def take_snapshot(summary: dict):
+        return {
+            "status": summary["status"]["description"],
+            "components": {c["name"]: c["status"] for c in summary["components"]},
+            "incidents": {i["name"]: i["status"] for i in summary["incidents"]},
+        }
+
+    @staticmethod
+    def diff(before: dict, after: dict):
+        changes = {}
+        if before["status"] != after["status"]:
+            changes["status"] = (before["status"], after["status"])
+        for key in ("components", "incidents"):
+            changed = {name: (before[key].get(name), status) for name, status in after[key].items()
+                       if before[key].get(name) != status}
+            changed.update({name: (status, None) for name, status in before[key].items() if name not in after[key]})
+            if changed:
+                changes[key] = changed
+        return changes
+
+    def build_embeds(self, summary: dict):
+        embed1 = discord.Embed(
+            title="Discord Status\nCurrent Status for Discord",
+            description="```yaml\n"
+                        f"Message: {summary['status']['description']}\n"
+                        f"Impact: {summary['status']['indicator'].title()}\n"
+                        "```",
+            colour=self.colour
+        )
+
+        embed2 = discord.Embed(title="Discord Status\nCurrent Incidents", colour=self.colour)
+        if not summary["incidents"]:
+            embed2.description = "```yaml\nThere are no issues with discord as of yet.```"
+        else:
+            embed2.description = "```yaml\n" + "\n\n".join(
+                f"Name: {incident.get('name', None)}\n"
+                f"Message: {incident.get('message', None)}\n"
+                f"Status: {incident.get('status', None).title()}\n"
+                f"Impact: {incident.get('impact', None).title()}" for incident in summary["incidents"]
+            ) + "```"
+
+        components = {c["name"]: c["status"].title().replace("_", " ") for c in summary["components"]}
+        width = len(max(components.keys(), key=len, default=""))
+        embed3 = discord.Embed(
+            title="Discord Status\nComponents",
+            description="```yaml\n" + "\n".join(f"{k.rjust(width)}: {v}" for k, v in components.items()) + "```",
+            colour=self.colour)
+        return [embed1, embed2, embed3]
+
+    def build_history_embeds(self, incidents: list):
+        created_dates = {}
+        embeds = []
+        for incident in incidents:
+            created_at = self.created_dates.get(incident["created_at"])
+            if created_at is None:
+                created_at = dateparser.parse(incident["created_at"])
+            created_dates[incident["created_at"]] = created_at
+            embeds.append(discord.Embed(
+                title="Discord Status\nHistorical Data",
+                description="```yaml\n"
+                            f"Name: {incident['name']}\n"
+                            f"Status: {incident['status'].title()}\n"
+                            f"Created: {humanize.naturaldate(created_at).title()}\n"
+                            f"Impact: {incident['impact'].title()}"
+                            f"```"))
+        self.created_dates = created_dates  # drops incidents that fell out of the history
+        return embeds
+
+    async def poll(self, http: HTTPClient):
+        summary, incidents = await asyncio.gather(http.get(self.SUMMARY_URL), http.get(self.INCIDENTS_URL))
+        summary, incidents = summary.json(), incidents.json()["incidents"]
+        snapshot = self.take_snapshot(summary)
+        changes = self.diff(self.snapshot, snapshot) if self.snapshot is not None else {}
+        self.snapshot = snapshot
+        self.embeds = self.build_embeds(summary)
+        self.history_embeds = self.build_history_embeds(incidents)
+        self.updated_at = datetime.datetime.utcnow()
+        return changes
+
+
+class DefinitionStore:
+    """
+    Word definitions from https://dictionaryapi.dev, stored as zlib compressed json in postgres with an LRU in front.
+    Unknown words are stored too and looked up again once they are older than `negative_ttl` seconds.
+    """
+    URL = "https://api.dictionaryapi.dev/api/v2/entries/en/{}"
+    MISSING = object()
+
+    def __init__(self, pool, http: HTTPClient, *, cache_size: int = 4096, negative_ttl: float = 7 * 24 * 60 * 60):
+        self.pool = pool
+        self.http = http
+        self.entries = LRUCache(cache_size)  # {word: entry or None if the word is unknown}
+        self.negative_ttl = datetime.timedelta(seconds=negative_ttl)
+        self.inflight = SingleFlight()
+
+    @staticmethod
+    def normalize(word: str):
+        return " ".join(word.lower().split())
+
+    async def get(self, word: str):
+        """
+        Returns the dictionary entry for a word, or None if the word is unknown.
+        """
+        word = self.normalize(word)
+        entry = self.entries.get(word, self.MISSING)
+        if entry is self.MISSING:
+            entry = await self.inflight.do(word, self.load, word)
+        return entry
+
+    async def load(self, word: str):
+        row = await self.pool.fetchrow("SELECT data, fetched_at FROM definitions WHERE word = $1", word)
+        if row is not None and (row["data"] is not None or datetime.datetime.utcnow() - row["fetched_at"] < self.negative_ttl):
+            entry = json.loads(zlib.decompress(row["data"])) if row["data"] is not None else None
+        else:
+            entry = await self.fetch(word)
+        self.entries[word] = entry
+        return entry
+
+    async def fetch(self, word: str):
+        r = await self.http.get(self.URL.format(quote(word)))
+        if r.status == 404:
+            entry = None
+        elif r.status == 200:
+            entry = r.json()[0]
+        else:  # not cached, it might work next time
+            raise aiohttp.ClientResponseError(None, (), status=r.status)
+        data = zlib.compress(json.dumps(entry).encode("utf-8")) if entry is not None else None
+        await self.pool.execute("""INSERT INTO definitions (word, data, fetched_at) VALUES ($1, $2, $3)
+        ON CONFLICT (word) DO UPDATE SET data = excluded.data, fetched_at = excluded.fetched_at""",
+                                word, data, datetime.datetime.utcnow())
+        return entry
+
+    async def warm(self, words: list, *, batch_size: int = 50):
+        """
+        Stores the definitions of words that aren't stored yet, without touching the LRU.
+        Returns how many words were fetched, already stored and unknown.
+        """
+        words = list(dict.fromkeys(filter(None, map(self.normalize, words))))
+        stored = {row["word"] for row in await self.pool.fetch("SELECT word FROM definitions WHERE word = any($1)", words)}
+        missing = [word for word in words if word not in stored]
+        fetched = unknown = 0
+        for i in range(0, len(missing), batch_size):
+            results = await asyncio.gather(*(self.fetch(word) for word in missing[i:i + batch_size]), return_exceptions=True)
+            for result in results:
+                if result is None:
+                    unknown += 1
+                elif not isinstance(result, Exception):
+                    fetched += 1
+        return fetched, len(stored), unknown
+
+
+class XkcdIndex:
+    """
+    The metadata of every xkcd comic, kept in postgres and in memory with an inverted index over titles and alt text.
+    """
+    def __init__(self):
+        self.comics = {}  # {num: comic}
+        self.numbers = []
+        self.titles = {}  # {normalized title: num}
+        self.title_index = defaultdict(set)  # {token: {num, ...}}
+        self.alt_index = defaultdict(set)
+        self.unavailable = set()  # numbers that 404, like 404
+
+    def __len__(self):
+        return len(self.comics)
+
+    @staticmethod
+    def tokenize(text: str):
+        return re.findall(r"[a-z0-9]+", text.lower())
+
+    @staticmethod
+    def parse(data: dict):
+        return {
+            "num": data["num"],
+            "title": data["safe_title"],
+            "alt": data["alt"],
+            "img": data["img"],
+            "date": datetime.date(int(data["year"]), int(data["month"]), int(data["day"])),
+        }
+
+    def add(self, comic: dict):
+        num = comic["num"]
+        if num in self.comics:
+            return
+        self.comics[num] = comic
+        self.numbers.append(num)
+        title_tokens = self.tokenize(comic["title"])
+        self.titles.setdefault(" ".join(title_tokens), num)
+        for token in title_tokens:
+            self.title_index[token].add(num)
+        for token in self.tokenize(comic["alt"]):
+            self.alt_index[token].add(num)
+
+    def get(self, num: int):
+        return self.comics.get(num)
+
+    def random(self):
+        return self.comics[random.choice(self.numbers)] if self.numbers else None
+
+    def search(self, query: str):
+        """
+        Returns the comic whose title matches the query exactly, otherwise the best match weighing title words over
+        alt text words. Words are weighted by how rare they are, so words most comics contain barely count.
+        """
+        tokens = self.tokenize(query)
+        if (num := self.titles.get(" ".join(tokens))) is not None:
+            return self.comics[num]
+        scores = Counter()
+        for token in set(tokens):
+            title_matches = self.title_index.get(token, set())
+            alt_matches = self.alt_index.get(token, set())
+            if not title_matches and not alt_matches:
+                continue
+            idf = math.log(len(self.comics) / len(title_matches | alt_matches))
+            for num in title_matches:
+                scores[num] += 3 * idf
+            for num in alt_matches:
+                scores[num] += idf
+        if not scores:
+            return None
+        best = max(scores, key=lambda num: (scores[num], num))
+        return self.comics[best] if scores[best] > 0 else None  # only words every comic has matched
+
+    async def load(self, pool):
+        for row in await pool.fetch("SELECT * FROM xkcd_comics ORDER BY num"):
+            self.add(dict(row))
+
+    async def refresh(self, pool, http: HTTPClient, *, batch_size: int = 50):
+        """
+        Fetches the comics that aren't indexed yet, newest first.
+        """
+        latest = (await http.get("https://xkcd.com/info.0.json")).json()["num"]
+        missing = [num for num in range(latest, 0, -1) if num not in self.comics and num not in self.unavailable]
+        added = 0
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            responses = await asyncio.gather(*(http.get(f"https://xkcd.com/{num}/info.0.json") for num in batch),
+                                             return_exceptions=True)
+            comics = []
+            for num, response in zip(batch, responses):
+                if isinstance(response, Exception):  # tried again on the next refresh
+                    continue
+                if response.status == 404:
+                    self.unavailable.add(num)
+                elif response.status == 200:
+                    comics.append(self.parse(response.json()))
+            await pool.executemany("""INSERT INTO xkcd_comics (num, title, alt, img, date) VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT DO NOTHING""", [(c["num"], c["title"], c["alt"], c["img"], c["date"]) for c in comics])
+            for comic in comics:
+                self.add(comic)
+            added += len(comics)
+        return added
+
+
+class TodoList:
+    """
+    A user's todo list. Tasks are kept in order of their position and indexed by name.
+    """
+    __slots__ = ("positions", "items", "index")
+
+    def __init__(self, rows=()):
+        self.positions = []  # sorted
+        self.items = {}  # position: (task, created_at)
+        self.index = {}  # task: position
+        for position, task, created_at in rows:
+            self.positions.append(position)
+            self.items[position] = (task, created_at)
+            self.index[task] = position
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, task):
+        return task in self.index
+
+    def __iter__(self):
+        return (self.items[position][0] for position in self.positions)
+
+    def __getitem__(self, i):
+        return self.items[self.positions[i]][0]
+
+    def get_item(self, position):
+        return self.items.get(position, None)
+
+    def add(self, task: str):
+        """
+        Adds a task to the end of the list and returns its position.
+        """
+        position = self.positions[-1] + 1 if self.positions else 1
+        self.positions.append(position)
+        self.items[position] = (task, datetime.datetime.utcnow())
+        self.index[task] = position
+        return position
+
+    def remove(self, task: str):
+        """
+        Removes a task by name and returns its position.
+        """
+        position = self.index.pop(task)
+        del self.positions[bisect.bisect_left(self.positions, position)]
+        del self.items[position]
+        return position
+
+    def pop(self, number: int):
+        """
+        Removes a task by its number in the list (starting from 1) and returns its position and name.
+        """
+        position = self.positions.pop(number - 1)
+        task, _ = self.items.pop(position)
+        del self.index[task]
+        return position, task
+
+
 # page sources
 
 
@@ -89,14 +1212,80 @@ class ErrorSource(menus.ListPageSource):
         traceback = f"```py\n{page['traceback']}```" if len(page["traceback"]) < 1991 else await menu.ctx.bot.mystbin(
             page["traceback"])
         embed = discord.Embed(title=f"Error Number {page['err_num']}", description=traceback)
-        for k, v in list(page.items()):
-            if k in ("err_num", "traceback"):
-                continue
+        embed.add_field(name="Type", value=f"`{page['error_type']}`")
+        embed.add_field(name="Occurrences", value=f"`{page['count']}`")
+        embed.add_field(name="First Seen", value=f"`{page['first_seen']:%Y-%m-%d %H:%M:%S}`")
+        embed.add_field(name="Last Seen", value=f"`{page['last_seen']:%Y-%m-%d %H:%M:%S}`")
+        for k in ("message", "command"):
+            v = page[k]
             value = f"`{v}`" if len(v) < 1000 else await menu.ctx.bot.mystbin(v)
-            embed.add_field(name=k.replace("_", " ").title(), value=value)
+            embed.add_field(name=k.title(), value=value)
+        embed.set_footer(text=f"Fingerprint {page['fingerprint']}")
         return embed
 
 
+class LazyErrorSource(menus.PageSource):
+    """
+    Pages through the errors table most frequent first, one error per page, without loading the whole table.
+    Errors are fetched `chunk_size` at a time with keyset pagination and the next chunk is prefetched.
+    """
+    def __init__(self, pool, *, chunk_size: int = 5):
+        self.pool = pool
+        self.chunk_size = chunk_size
+        self.cursors = [None]  # the (count, err_num) each chunk starts after
+        self.chunks = LRUCache(3)
+        self.fetches = {}
+
+    def is_paginating(self):
+        return True
+
+    def get_max_pages(self):
+        return None
+
+    async def fetch_chunk(self, index):
+        cursor = self.cursors[index]
+        if cursor is None:
+            rows = await self.pool.fetch("SELECT * FROM errors ORDER BY count DESC, err_num LIMIT $1", self.chunk_size)
+        else:
+            # count <= $1 bounds the scan of errors_count_idx, the rest filters out the rows already shown
+            rows = await self.pool.fetch("""SELECT * FROM errors WHERE count <= $1 AND (count < $1 OR err_num > $2)
+            ORDER BY count DESC, err_num LIMIT $3""", *cursor, self.chunk_size)
+        if len(rows) == self.chunk_size and len(self.cursors) == index + 1:
+            self.cursors.append((rows[-1]["count"], rows[-1]["err_num"]))
+        return rows
+
+    def start_fetch(self, index):
+        if index not in self.fetches:
+            self.fetches[index] = asyncio.ensure_future(self.fetch_chunk(index))
+        return self.fetches[index]
+
+    async def get_chunk(self, index):
+        rows = self.chunks.get(index)
+        if rows is None:
+            try:
+                rows = await asyncio.shield(self.start_fetch(index))
+            finally:
+                if self.fetches.get(index) and self.fetches[index].done():
+                    del self.fetches[index]
+            self.chunks[index] = rows
+        return rows
+
+    async def get_page(self, page_number):
+        if page_number < 0:  # MenuPages doesn't bound check without a max page count
+            raise IndexError(page_number)
+        index, offset = divmod(page_number, self.chunk_size)
+        if index >= len(self.cursors):
+            raise IndexError(page_number)
+        rows = await self.get_chunk(index)
+        if offset >= len(rows):
+            raise IndexError(page_number)
+        if index + 1 < len(self.cursors) and index + 1 not in self.chunks:
+            self.start_fetch(index + 1)
+        return rows[offset]
+
+    format_page = ErrorSource.format_page
+
+
 class HelpSource(menus.ListPageSource):
     """
     Page Source for paginated help command.
@@ -123,34 +1312,22 @@ class HelpSource(menus.ListPageSource):
 
 class DiscordStatusSource(menus.ListPageSource):
     def format_page(self, menu: menus.MenuPages, page):
+        page = page.copy()  # the embeds are shared between menus
         page.set_footer(text=f"Page {menu.current_page + 1}/{self.get_max_pages()}")
         return page
 
 
-class HistorySource(menus.ListPageSource):
-    async def format_page(self, menu: menus.MenuPages, page):
-        embed = discord.Embed(
-            title="Discord Status\nHistorical Data",
-            description="```yaml\n"
-                        f"Name: {page['name']}\n"
-                        f"Status: {page['status'].title()}\n"
-                        f"Created: {humanize.naturaldate(dateparser.parse(page['created_at'])).title()}\n"
-                        f"Impact: {page['impact'].title()}" 
-                        f"```")
-        embed.set_footer(text=f"Page {menu.current_page + 1}/{self.get_max_pages()}")
-        return embed
-
-
 class DefineSource(menus.ListPageSource):
-    def __init__(self, data, response):
-        super().__init__(data, per_page=1)
-        self.response = response
+    def __init__(self, entry):
+        super().__init__(entry["meanings"], per_page=1)
+        self.entry = entry
 
     async def format_page(self, menu: menus.MenuPages, page):
+        phonetics = self.entry["phonetics"][0] if self.entry["phonetics"] else {}
         embed = discord.Embed(
-            title=f"Definitions for word `{self.response['word']}`",
-            description=f"{self.response['phonetics'][0]['text']}\n"
-                        f"[audio]({self.response['phonetics'][0]['audio']})",
+            title=f"Definitions for word `{self.entry['word']}`",
+            description=f"{phonetics.get('text', '')}\n"
+                        f"[audio]({phonetics.get('audio', '')})",
             colour=menu.ctx.bot.embed_colour)
         defs = []
         for definition in page["definitions"]: